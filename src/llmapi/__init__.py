@@ -1,5 +1,9 @@
 from .llmprompt import LlmPrompt
 from .llmpromptset import LlmPromptSet
+from .llmcache import LlmCache
+from .llmbackends import register_backend, get_backend, shutdown_backends
+from .timing import Timings, timings
+from .fileutils import atomic_write
 
 from .exceptionwrapper import ExceptionWrapper
-from .texttools import get_partially_repeating_pattern, get_repeating_pattern, split_markdown_by_headers
+from .texttools import get_partially_repeating_pattern, get_repeating_pattern, split_markdown_by_headers, split_markdown_blocks, split_markdown_by_token_budget, RepetitionDetector, TextSegments
@@ -0,0 +1,18 @@
+import os, threading
+
+def atomic_write(path, data, mode='w'):
+    """
+    Write data (str for mode 'w', bytes for mode 'wb') to the file path through a temporary file
+    next to it that is then renamed, so that concurrent readers never see a partial file and an
+    interrupted write never leaves one behind.
+    """
+    # Named by process and thread, so that concurrent writers of the same path do not collide
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    try:
+        with open(tmp_path, mode) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
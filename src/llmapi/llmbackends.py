@@ -0,0 +1,150 @@
+import threading, atexit, logging
+
+from . import llmmodels
+
+class Backend:
+    """
+    A registered LLM backend.
+
+    Attributes
+    ----------
+    factory : callable
+        factory(opts) creates a backend instance, i.e., an object with run() and stream().
+    key : callable
+        key(opts) gives the hashable part of opts that the instance depends on; instances are
+        reused for all prompts with the same key. If None, each prompt gets a new instance.
+    parallel : int
+        Default number of prompts in flight at the same time.
+    split_tokens : int
+        Default number of tokens of text per prompt for the token-budget split mode.
+    """
+    def __init__(self, factory, key=None, parallel=1, split_tokens=2048):
+        self.factory = factory
+        self.key = key
+        self.parallel = parallel
+        self.split_tokens = split_tokens
+
+_backends = {}
+_instances = {}
+_lock = threading.Lock()
+
+def register_backend(name, factory, key=lambda opts: (), parallel=1, split_tokens=2048):
+    """
+    Register an LLM backend under name (see Backend for the arguments), replacing any backend
+    already registered under that name.
+    """
+    with _lock:
+        _backends[name] = Backend(factory, key, parallel, split_tokens)
+
+def get_backend_info(name):
+    if name not in _backends:
+        raise Exception("Unknown LLM backend requested: "+str(name))
+    return _backends[name]
+
+def get_backend(name, opts):
+    """
+    Return an instance of the backend registered under name for opts, reusing an earlier
+    instance (with its warm connections and processes) when there is one.
+    """
+    backend = get_backend_info(name)
+    if backend.key is None:
+        return backend.factory(opts)
+
+    key = (name, backend.key(opts))
+    with _lock:
+        if key not in _instances:
+            _instances[key] = backend.factory(opts)
+        return _instances[key]
+
+def shutdown_backends():
+    """
+    Stop all backend instances that have a stop() method (e.g., server processes and client
+    event loops), and forget all instances. Called automatically at exit.
+    """
+    with _lock:
+        instances = list(_instances.values())
+        _instances.clear()
+    for instance in instances:
+        if hasattr(instance, 'stop'):
+            try:
+                instance.stop()
+            except Exception as e:
+                logging.warning("llmbackends: could not stop backend: "+str(e))
+
+atexit.register(shutdown_backends)
+
+
+def _openai(opts):
+    if getattr(opts, 'openai_key', None) is None:
+        raise Exception("Trying to use OpenAI without API key set")
+    return llmmodels.OpenAI(
+        api_key=opts.openai_key,
+        model=getattr(opts, 'openai_model', None) or "gpt-4o",
+        base_url=getattr(opts, 'openai_base_url', None),
+        max_concurrency=getattr(opts, 'parallel', None) or 8,
+        requests_per_minute=getattr(opts, 'openai_rpm', None),
+        tokens_per_minute=getattr(opts, 'openai_tpm', None),
+    )
+
+def _openai_key(opts):
+    return tuple(getattr(opts, attr, None) for attr in ['openai_key', 'openai_model', 'openai_base_url', 'parallel', 'openai_rpm', 'openai_tpm'])
+
+def _copilot(opts):
+    if getattr(opts, 'copilot_key', None) is None:
+        raise Exception("Trying to use Copilot without key (cookie) set")
+    return llmmodels.Copilot(key=opts.copilot_key)
+
+def _fake(opts):
+    return llmmodels.FakeLlm(latency=getattr(opts,'fake_latency',0.0), token_rate=getattr(opts,'fake_token_rate',None), repeat=getattr(opts,'fake_repeat',False))
+
+def _fake_key(opts):
+    return tuple(getattr(opts, attr, None) for attr in ['fake_latency', 'fake_token_rate', 'fake_repeat'])
+
+def _transcript(opts):
+    if getattr(opts, 'transcript', None) is None:
+        raise Exception("Trying to record or replay without a transcript file set")
+    return opts.transcript
+
+def _record_backend(opts):
+    return getattr(opts, 'record_backend', None) or 'localllama'
+
+def _record(opts):
+    name = _record_backend(opts)
+    # The wrapped backend is looked up for every prompt, so that it is reused (or not) as usual
+    return llmmodels.TranscriptRecorder(lambda: get_backend(name, opts), _transcript(opts), name=name)
+
+def _record_key(opts):
+    name = _record_backend(opts)
+    key = get_backend_info(name).key
+    return (name, getattr(opts, 'transcript', None), key(opts) if key is not None else None)
+
+def _replay(opts):
+    time_scale = getattr(opts, 'replay_time_scale', None)
+    return llmmodels.TranscriptReplayer(_transcript(opts), time_scale=1.0 if time_scale is None else time_scale)
+
+def _replay_key(opts):
+    return (getattr(opts, 'transcript', None), getattr(opts, 'replay_time_scale', None))
+
+def _prompt_cache_dir(opts):
+    if getattr(opts, 'no_prompt_cache', False):
+        return None
+    return getattr(opts, 'prompt_cache_dir', None)
+
+def _llamaserver_slots(opts):
+    # One server slot per request in flight, so that -j also sets how many the server runs at a time
+    return getattr(opts, 'parallel', None) or 1
+
+def _llamaserver(opts):
+    return llmmodels.LocalLlamaServer(slots=_llamaserver_slots(opts), prompt_cache_dir=_prompt_cache_dir(opts))
+
+def _llamaserver_key(opts):
+    return (_prompt_cache_dir(opts), _llamaserver_slots(opts))
+
+register_backend('localllama', lambda opts: llmmodels.LocalLlama8B(prompt_cache_dir=_prompt_cache_dir(opts)), key=lambda opts: _prompt_cache_dir(opts), parallel=1, split_tokens=2048)
+register_backend('llamaserver', _llamaserver, key=_llamaserver_key, parallel=1, split_tokens=2048)
+register_backend('openai', _openai, key=_openai_key, parallel=8, split_tokens=4096)
+# The sydney client runs each request in its own event loop, so it is not shared between prompts
+register_backend('copilot', _copilot, key=None, parallel=1, split_tokens=2048)
+register_backend('fake', _fake, key=_fake_key, parallel=1, split_tokens=2048)
+register_backend('record', _record, key=_record_key, parallel=1, split_tokens=2048)
+register_backend('replay', _replay, key=_replay_key, parallel=1, split_tokens=2048)
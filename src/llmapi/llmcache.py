@@ -0,0 +1,110 @@
+import os, json, hashlib, threading
+
+from .fileutils import atomic_write
+
+class LlmCache:
+    """
+    On-disk cache of LLM responses.
+
+    Entries are keyed on a hash of the backend, its sampling parameters and the
+    system and user prompts. The cache is bounded in size; when it grows past
+    max_size bytes the least recently used entries are removed.
+    """
+
+    _instances = {}
+    _lock = threading.Lock()
+
+    # Backend attributes that affect the output and thus are part of the key
+    key_attributes = ['model', 'model_path', 'temperature', 'top_p', 'seed', 'style']
+
+    def __init__(self, cache_dir, max_size=1024*1024*1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def shared(cls, cache_dir, max_size=1024*1024*1024):
+        with cls._lock:
+            if cache_dir not in cls._instances:
+                cls._instances[cache_dir] = cls(cache_dir, max_size)
+            return cls._instances[cache_dir]
+
+    @classmethod
+    def from_opts(cls, opts):
+        """
+        Return the cache selected by opts.cache_dir and opts.cache_size (in MiB), or None
+        if no cache directory is set.
+        """
+        cache_dir = getattr(opts, 'cache_dir', None)
+        if cache_dir is None:
+            return None
+        cache_size = getattr(opts, 'cache_size', None)
+        if cache_size is None:
+            return cls.shared(cache_dir)
+        return cls.shared(cache_dir, int(cache_size*1024*1024))
+
+    @classmethod
+    def key(cls, backend, llm, system, user):
+        params = {'backend': backend}
+        for attr in cls.key_attributes:
+            if hasattr(llm, attr):
+                params[attr] = getattr(llm, attr)
+        params['system'] = system
+        params['user'] = user
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+            # Touching the entry marks it as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry['output']
+
+    def put(self, key, output):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        atomic_write(path, json.dumps({'output': output}))
+
+        with self.lock:
+            if self.size is None:
+                self.size = sum([size for _, size, _ in self._entries()])
+            else:
+                self.size += os.path.getsize(path)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries += [(st.st_mtime, st.st_size, path)]
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        self.size = sum([size for _, size, _ in entries])
+        for _, size, path in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
@@ -1,13 +1,72 @@
-import subprocess, sys, threading, os, asyncio, collections
+import subprocess, sys, threading, os, asyncio, collections, json, socket, time, queue, hashlib, selectors, codecs
+import urllib.request, urllib.error
 
-from .texttools import get_partially_repeating_pattern
+from .texttools import RepetitionDetector, estimate_tokens
+from .ratelimit import TokenBucket, retry_delay
+from .timing import timings
+
+def llama3_prompt(system, user):
+    # llama.cpp now seems to warn about a double BOS token
+    #prompt = "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n"
+    prompt = "<|start_header_id|>system<|end_header_id|>\n"
+    prompt += system + "\n"
+    prompt += "<|start_header><header_id|>user<|end_header_id|>\n"
+    prompt += user + "\n"
+    prompt += "<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+    return prompt
+
+def prompt_cache_name(kind, model_path, system):
+    """
+    Return the file name under which the evaluated state (KV cache) of the llama3 prompt
+    prefix up to and including the system prompt is saved for the model in model_path.
+    The llama-cli prompt cache and llama-server slot files differ in format, which kind
+    ('cli' or 'slot') tells apart.
+    """
+    params = {'model_path': os.path.abspath(model_path), 'system': system}
+    # A replaced model file invalidates the saved states
+    if os.path.exists(model_path):
+        stat = os.stat(model_path)
+        params['model'] = [stat.st_size, stat.st_mtime]
+    return kind + "-" + hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf8')).hexdigest() + ".bin"
+
+def strip_stream(chunks):
+    """
+    Strip leading and trailing whitespace from a stream of text chunks, i.e., the
+    streaming counterpart of str.strip().
+    """
+    started = False
+    whitespace = ""
+    for chunk in chunks:
+        if not started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                continue
+            started = True
+        stripped = chunk.rstrip()
+        if stripped:
+            yield whitespace + stripped
+            whitespace = chunk[len(stripped):]
+        else:
+            whitespace += chunk
 
 class LocalLlama8B():
-    def __init__(self, model_path='llama.cpp/models/lama-8B.gguf', seed=42, gpu_layers=35, context_window=65535):
+    """
+    Local llama.cpp backend that runs llama-cli for every prompt.
+
+    If prompt_cache_dir is set, the evaluated prompt of the first prompt with a given system
+    prompt is saved there with --prompt-cache, and later prompts with the same system prompt
+    load it read-only, so that llama.cpp only evaluates the part after the shared prefix.
+    """
+    def __init__(self, model_path='llama.cpp/models/lama-8B.gguf', seed=42, gpu_layers=35, context_window=65535, prompt_cache_dir=None):
         self.model_path = model_path
+        self.prompt_cache_dir = prompt_cache_dir
+        self._prompt_cache_locks = collections.defaultdict(threading.Lock)
+        self._prompt_cache_lock = threading.Lock()
         self.seed = seed
         self.gpu_layers = gpu_layers
         self.context_window = context_window
+        self.temperature = 0.2
+        self.top_p = 0.2
         self.base_command = [
             "./llama.cpp/llama-cli",
             "-m", self.model_path,
@@ -18,160 +77,641 @@ class LocalLlama8B():
             #"--repeat-penalty","1.0",
             "-r", "<|eot_id|>",
             "-s", str(self.seed),
-            "--temp", str(0.2),
-            "--top-p", str(0.2),
+            "--temp", str(self.temperature),
+            "--top-p", str(self.top_p),
             "-ngl", str(self.gpu_layers),
             "-c", str(self.context_window),
             "-f", "/dev/stdin"
         ]
 
-    def _read_stream(self, stream, handler):
-        while True:
-            chunk = stream.read(1024)  # Read in chunks of 1024 bytes
-            if not chunk:
-                break
-            sys.stderr.write(chunk)
-            sys.stderr.flush()
-            handler(chunk)
-        stream.close()
-                    
-    def run(self, system, user, opts=None):
+    def _prompt_cache_lock_for(self, filename):
+        with self._prompt_cache_lock:
+            return self._prompt_cache_locks[filename]
 
-        # llama.cpp now seems to warn about a double BOS token
-        #prompt = "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n"
-        prompt = "<|start_header_id|>system<|end_header_id|>\n"
-        prompt += system + "\n"
-        prompt += "<|start_header><header_id|>user<|end_header_id|>\n"
-        prompt += user + "\n"
-        prompt += "<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
+    def _prompt_cache_args(self, system):
+        """
+        Return the llama-cli arguments for the prompt cache of system, and the lock to hold while
+        the process runs, if the cache file is to be written by this process.
+        """
+        if self.prompt_cache_dir is None:
+            return [], None
+        os.makedirs(self.prompt_cache_dir, exist_ok=True)
+        filename = os.path.join(self.prompt_cache_dir, prompt_cache_name('cli', self.model_path, system))
 
-        try:
-            process = subprocess.Popen(self.base_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            stop_event = threading.Event()
+        # The first prompt with this system prompt writes the cache file, concurrent prompts wait for it
+        lock = self._prompt_cache_lock_for(filename)
+        lock.acquire()
+        if os.path.exists(filename):
+            lock.release()
+            return ["--prompt-cache", filename, "--prompt-cache-ro"], None
+        return ["--prompt-cache", filename], lock
+
+    def _communicate(self, process, prompt):
+        """
+        Write prompt to the stdin of process and yield the text of its stdout as soon as it is
+        available, until the process closes it. The stderr of the process is passed on to
+        sys.stderr, as is stdout.
 
-            # Send the prompt to stdin and immediately close stdin since no more input is expected
-            process.stdin.write(prompt)
-            process.stdin.close()
+        A single selector waits on all three pipes, so no threads are needed, and every
+        read returns whatever output is available rather than waiting for a full buffer.
+        """
+        decoder = codecs.getincrementaldecoder('utf8')(errors='replace')
+        pending = prompt.encode('utf8')
 
-            all_output = []
-            recent_lines = collections.deque(maxlen=30)
-            empty = 0
-            buff = ""
+        with selectors.DefaultSelector() as selector:
+            os.set_blocking(process.stdin.fileno(), False)
+            selector.register(process.stdin, selectors.EVENT_WRITE)
+            selector.register(process.stdout, selectors.EVENT_READ)
+            selector.register(process.stderr, selectors.EVENT_READ)
 
-            # Function to append to all_output list
-            def append_output(data):
-                nonlocal empty, recent_lines, all_output, buff
+            while selector.get_map():
+                for key, _ in selector.select():
+                    if key.fileobj is process.stdin:
+                        try:
+                            pending = pending[os.write(key.fd, pending[:65536]):]
+                        except BrokenPipeError:
+                            pending = b""
+                        if not pending:
+                            # Closing stdin tells llama.cpp that the whole prompt has been sent
+                            selector.unregister(process.stdin)
+                            process.stdin.close()
+                        continue
+
+                    data = os.read(key.fd, 65536)
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        continue
+                    if key.fileobj is process.stderr:
+                        sys.stderr.write(data.decode('utf8', errors='replace'))
+                        sys.stderr.flush()
+                        continue
+
+                    text = decoder.decode(data)
+                    sys.stderr.write(text)
+                    sys.stderr.flush()
+                    if text:
+                        yield text
 
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+    def stream(self, system, user, opts=None):
+
+        prompt = llama3_prompt(system, user)
+
+        prompt_cache_args, prompt_cache_lock = self._prompt_cache_args(system)
+        try:
+            process = subprocess.Popen(self.base_command + prompt_cache_args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except Exception:
+            if prompt_cache_lock is not None:
+                prompt_cache_lock.release()
+            raise
+
+        detector = RepetitionDetector(window=500, max_pattern_length=100, max_lines=30)
+        started = False
+        loop_detected = False
+        buff = ""
+        # The latest line is held back, so that a final <|eot_id|> can be removed
+        held = ""
+
+        output = self._communicate(process, prompt)
+        try:
+            for data in output:
                 buff += data
 
-                # If buff is long and has no line breaks, check for max 100 character long repeats in the last 500 characters:
-                if "\n" not in buff and len(buff) > 500:
-                    pattern = get_partially_repeating_pattern(buff[-500:],100)
-                    if pattern:
-                        all_output.append(buff)
-                        buff = ""
-                        stop_event.set()
-                        raise Exception("Loop detected")
+                # Stop on a line with more than 500 characters that ends in max 100 character long repeats,
+                # or when none of the last 30 lines is unique
+                loop_detected = detector.feed(data)
 
                 while "\n" in buff:
                     line, buff = buff.split("\n",1)
-                
+
                     # Only dump output after an empty line saying 'assistant'.
-                    if len(all_output) > 0:
-                        all_output.append(line+"\n")
+                    if started:
+                        if held:
+                            yield held
+                        held = line+"\n"
                     if line.strip() == 'assistant':
-                        all_output.append("")
-                        
-                    recent_lines.append(line.strip())
-                    counts = collections.Counter(recent_lines).items()
-                    if len([k for k,v in counts if v==1]) == 0:
-                        stop_event.set()
-                        raise Exception("Loop detected")
-
-             # Function to print stderr output to stderr
-            def print_stderr(data):
-                sys.stderr.write(data)
-                sys.stderr.flush()
+                        started = True
 
-            # Thread to handle stdout
-            stdout_thread = threading.Thread(target=self._read_stream, args=(process.stdout, append_output))
-            stdout_thread.start()
-
-            # Thread to handle stderr
-            stderr_thread = threading.Thread(target=self._read_stream, args=(process.stderr, print_stderr))
-            stderr_thread.start()
-
-            # Wait for the subprocess to complete
-            while stdout_thread.is_alive():
-                stdout_thread.join(timeout=1)
-                if stop_event.is_set():
-                    process.terminate()
-                    stdout_thread.join()
-                    stderr_thread.join()
-                    sys.stderr.flush()
-                    print("WARNING: stopped LLM process due to loop detection.")
-                    if len(all_output) > 0:
-                        all_output.append(buff)
-                    all_output.append("<|loop_detected|>")
+                if loop_detected:
                     break
+
+            if loop_detected:
+                # The process is stopped right away, rather than when it next writes output
+                output.close()
+                process.terminate()
+                process.wait()
+                sys.stderr.flush()
+                print("WARNING: stopped LLM process due to loop detection.")
+                if started:
+                    yield held + buff
+                yield "<|loop_detected|>"
             else:
-                stderr_thread.join()
                 process.wait()
                 sys.stderr.flush()
-                if len(all_output) > 0:
-                    all_output.append(buff)
 
                 # Check if there was an error
                 if process.returncode != 0:
                     raise subprocess.CalledProcessError(process.returncode, process.args, output=None, stderr=None)
 
-            all_output = ''.join(all_output)
-
-            if all_output.endswith('<|eot_id|>'):
-                all_output = all_output[:-len('<|eot_id|>')]
+                if started:
+                    last = held + buff
+                    if last.endswith('<|eot_id|>'):
+                        last = last[:-len('<|eot_id|>')]
+                    yield last
 
             # Make sure a final new paragraph is printed to separate the LLM output from forthcoming log messages.
             sys.stderr.write("\n\n")
-                
-            return all_output
-        
-        except subprocess.CalledProcessError as e:
-            print(f"Error running llama.cpp: {e}", file=sys.stderr)
-            return None
+
+        finally:
+            output.close()
+            # Also stop the process if the consumer stops reading the stream early
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+            for pipe in [process.stdin, process.stdout, process.stderr]:
+                pipe.close()
+            # A process that failed may have left a partial prompt cache file, which would make later runs fail
+            if prompt_cache_args and process.returncode != 0 and not loop_detected:
+                try:
+                    os.remove(prompt_cache_args[1])
+                except OSError:
+                    pass
+            if prompt_cache_lock is not None:
+                prompt_cache_lock.release()
+
+    def run(self, system, user, opts=None):
+        # A failing llama-cli raises CalledProcessError, as the other backends raise their errors
+        return ''.join(self.stream(system, user, opts))
+
+class FakeLlm():
+    """
+    Offline stand-in for an LLM backend, used for benchmarks. It echoes the user prompt
+    after a fixed latency, producing tokens at token_rate tokens per second (or as fast as
+    possible if None). With repeat set it instead starts repeating itself, and stops via
+    loop detection the same way LocalLlama8B does.
+    """
+    def __init__(self, latency=0.0, token_rate=None, repeat=False, chars_per_token=4):
+        self.model = "fake"
+        self.latency = latency
+        self.token_rate = token_rate
+        self.repeat = repeat
+        self.chars_per_token = chars_per_token
+
+    def stream(self, system, user, opts=None):
+        time.sleep(self.latency)
+
+        text = user
+        if self.repeat:
+            text = user[:len(user)//2] + "and the same thing again "*(len(user)//25 + 100)
+        detector = RepetitionDetector()
+
+        start = time.monotonic()
+        for n, i in enumerate(range(0, len(text), self.chars_per_token)):
+            if self.token_rate:
+                delay = start + n/self.token_rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            token = text[i:i+self.chars_per_token]
+            yield token
+            if self.repeat and detector.feed(token):
+                yield "<|loop_detected|>"
+                return
+
+    def run(self, system, user, opts=None):
+        return ''.join(self.stream(system, user, opts))
+
+
+def transcript_key(system, user):
+    return hashlib.sha256((system + "\0" + user).encode('utf8')).hexdigest()
+
+class TranscriptRecorder():
+    """
+    Wraps another backend, the instance of which get_backend() returns, and appends every
+    interaction with it to the transcript file filename, one JSON object per line: the backend
+    name, system and user prompt, whether it was a run() or stream() call, and the output
+    chunks, each with its time in seconds since the call. See TranscriptReplayer.
+    """
+    cacheable = False
+
+    def __init__(self, get_backend, filename, name=None):
+        self.get_backend = get_backend
+        self.name = name
+        self.model = "record"
+        self.file = open(filename, 'a')
+        self.lock = threading.Lock()
+
+    def stop(self):
+        with self.lock:
+            self.file.close()
+
+    def _write(self, system, user, mode, chunks):
+        record = {'backend': self.name, 'system': system, 'user': user, 'mode': mode, 'chunks': chunks}
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def stream(self, system, user, opts=None):
+        start = time.monotonic()
+        chunks = []
+        for chunk in self.get_backend().stream(system, user, opts):
+            chunks.append([time.monotonic() - start, chunk])
+            yield chunk
+        # Only complete interactions are recorded
+        self._write(system, user, 'stream', chunks)
+
+    def run(self, system, user, opts=None):
+        start = time.monotonic()
+        output = self.get_backend().run(system, user, opts)
+        self._write(system, user, 'run', [[time.monotonic() - start, output]])
+        return output
+
+
+class TranscriptReplayer():
+    """
+    Offline backend that answers prompts from a transcript written by TranscriptRecorder, with the
+    recorded timing multiplied by time_scale (1.0 replays at the original speed, 0.0 without any
+    waiting). Prompts that were recorded several times get the recorded outputs in turn. Prompts
+    that are not in the transcript raise an exception.
+    """
+    cacheable = False
+
+    def __init__(self, filename, time_scale=1.0):
+        self.model = "replay"
+        self.time_scale = time_scale
+        self.records = collections.defaultdict(list)
+        with open(filename) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self.records[transcript_key(record['system'], record['user'])].append(record)
+        self.uses = collections.Counter()
+        self.lock = threading.Lock()
+
+    def _record(self, system, user):
+        key = transcript_key(system, user)
+        if key not in self.records:
+            raise Exception("No recorded response in the transcript for prompt: "+user[:80])
+        with self.lock:
+            records = self.records[key]
+            record = records[self.uses[key] % len(records)]
+            self.uses[key] += 1
+        return record
+
+    def stream(self, system, user, opts=None):
+        record = self._record(system, user)
+        start = time.monotonic()
+        for seconds, chunk in record['chunks']:
+            delay = start + seconds*self.time_scale - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            yield chunk
+
+    def run(self, system, user, opts=None):
+        record = self._record(system, user)
+        if record['chunks']:
+            time.sleep(record['chunks'][-1][0]*self.time_scale)
+        return ''.join([chunk for seconds, chunk in record['chunks']])
+
+
+class LocalLlamaServer():
+    """
+    Local llama.cpp backend that keeps a single llama-server process running with the
+    model loaded, and sends every prompt to it over a local HTTP socket.
+
+    The backend registry (llmbackends) keeps one instance per set of arguments, so that all
+    prompts in a run reuse the same loaded model. The server is started on first use and
+    terminated by stop(), which the registry calls at exit.
+
+    Each prompt is sent to a slot of its own, and the server reuses the part of the slot's KV
+    cache that matches the start of the prompt. If prompt_cache_dir is set, the state of a slot
+    is also saved there after the first prompt with a given system prompt, and restored into the
+    slot before later prompts with that system prompt, also in later runs.
+    """
+    def __init__(self, model_path='llama.cpp/models/lama-8B.gguf', seed=42, gpu_layers=35, context_window=65535, slots=1, host="127.0.0.1", port=None, startup_timeout=600, prompt_cache_dir=None):
+        self.model_path = model_path
+        self.prompt_cache_dir = prompt_cache_dir
+        # Free slots, and the saved state last loaded into or saved from each slot
+        self._free_slots = queue.Queue()
+        for slot in range(slots):
+            self._free_slots.put(slot)
+        self._slot_state = {}
+        self.seed = seed
+        self.gpu_layers = gpu_layers
+        self.context_window = context_window
+        self.slots = slots
+        self.host = host
+        self.port = port
+        self.startup_timeout = startup_timeout
+        self.temperature = 0.2
+        self.top_p = 0.2
+        self.process = None
+        self._start_lock = threading.Lock()
+
+    def _url(self, path):
+        return "http://" + self.host + ":" + str(self.port) + path
+
+    def _open(self, path, data=None, timeout=None):
+        if data is not None:
+            data = json.dumps(data).encode('utf8')
+        request = urllib.request.Request(self._url(path), data=data, headers={'Content-Type': 'application/json'})
+        return urllib.request.urlopen(request, timeout=timeout)
+
+    def _request(self, path, data=None, timeout=None):
+        with self._open(path, data, timeout) as response:
+            return json.loads(response.read().decode('utf8'))
+
+    def start(self):
+        with self._start_lock:
+            if self.process is not None and self.process.poll() is None:
+                return
+
+            if self.port is None:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    s.bind((self.host, 0))
+                    self.port = s.getsockname()[1]
+
+            command = [
+                "./llama.cpp/llama-server",
+                "-m", self.model_path,
+                "-fa",
+                "-ngl", str(self.gpu_layers),
+                "-c", str(self.context_window),
+                "-np", str(self.slots),
+                "--host", self.host,
+                "--port", str(self.port),
+            ]
+            if self.prompt_cache_dir is not None:
+                os.makedirs(self.prompt_cache_dir, exist_ok=True)
+                command += ["--slot-save-path", self.prompt_cache_dir]
+            self.process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+            # The server answers /health with 503 while the model is loading
+            deadline = time.monotonic() + self.startup_timeout
+            while True:
+                if self.process.poll() is not None:
+                    raise subprocess.CalledProcessError(self.process.returncode, command)
+                try:
+                    self._request("/health", timeout=5)
+                    break
+                except (urllib.error.URLError, ConnectionError):
+                    pass
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise Exception("Timeout waiting for llama.cpp server to load the model")
+                time.sleep(0.5)
+
+    def stop(self):
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+            self.process = None
+
+    def _slot_action(self, slot, action, filename):
+        try:
+            self._request("/slots/" + str(slot) + "?action=" + action, {'filename': filename})
+            return True
+        except (urllib.error.URLError, ConnectionError) as e:
+            print(f"WARNING: could not {action} llama.cpp server slot {slot}: {e}", file=sys.stderr)
+            return False
+
+    def _acquire_slot(self, system):
+        slot = self._free_slots.get()
+        state = None
+        if self.prompt_cache_dir is not None:
+            state = prompt_cache_name('slot', self.model_path, system)
+            if self._slot_state.get(slot) != state and os.path.exists(os.path.join(self.prompt_cache_dir, state)):
+                if self._slot_action(slot, "restore", state):
+                    self._slot_state[slot] = state
+        return slot, state
+
+    def _release_slot(self, slot, state, completed):
+        try:
+            if completed and state is not None and self._slot_state.get(slot) != state:
+                if not os.path.exists(os.path.join(self.prompt_cache_dir, state)):
+                    self._slot_action(slot, "save", state)
+                self._slot_state[slot] = state
+        finally:
+            self._free_slots.put(slot)
+
+    def _completion_data(self, system, user, slot):
+        return {
+            'id_slot': slot,
+            'prompt': llama3_prompt(system, user),
+            'n_predict': -1,
+            'seed': self.seed,
+            'temperature': self.temperature,
+            'top_p': self.top_p,
+            'mirostat': 2,
+            'stop': ["<|eot_id|>"],
+            'cache_prompt': True,
+        }
+
+    def _annotate(self, response):
+        # The final response has the token counts; prompt tokens taken from the slot's cache are not evaluated
+        if 'tokens_evaluated' in response and 'tokens_predicted' in response:
+            timings.annotate("llm", prompt_tokens=response['tokens_evaluated'], completion_tokens=response['tokens_predicted'], cached_tokens=response.get('tokens_cached'))
+
+    def stream(self, system, user, opts=None):
+        self.start()
+
+        slot, state = self._acquire_slot(system)
+        completed = False
+        try:
+            data = self._completion_data(system, user, slot)
+            data['stream'] = True
+
+            # The server sends server-sent events, one 'data: {...}' line per chunk of tokens
+            with self._open("/completion", data) as response:
+                for line in response:
+                    line = line.decode('utf8').strip()
+                    if not line.startswith("data: "):
+                        continue
+                    chunk = json.loads(line[len("data: "):])
+                    if chunk.get('content'):
+                        yield chunk['content']
+                    if chunk.get('stop'):
+                        self._annotate(chunk)
+                        completed = True
+                        break
+        finally:
+            self._release_slot(slot, state, completed)
+
+    def run(self, system, user, opts=None):
+        self.start()
+
+        slot, state = self._acquire_slot(system)
+        completed = False
+        try:
+            response = self._request("/completion", self._completion_data(system, user, slot))
+            self._annotate(response)
+            completed = True
+        finally:
+            self._release_slot(slot, state, completed)
+        return response['content']
+
 
 class OpenAI():
-    def __init__(self, api_key, model="gpt-4o", max_tokens=None):
+    """
+    OpenAI chat completions backend.
+
+    All requests go through one AsyncOpenAI client, and thus one connection pool, running on a
+    background event loop; the backend registry (llmbackends) keeps one instance per set of
+    arguments and calls stop() at exit. At most max_concurrency requests are in flight,
+    optionally limited further to requests_per_minute and tokens_per_minute, and requests
+    failing with 429, 5xx or connection errors are retried up to max_retries times with
+    exponential backoff, honoring retry-after.
+    """
+    def __init__(self, api_key, model="gpt-4o", max_tokens=None, base_url=None, max_concurrency=8, requests_per_minute=None, tokens_per_minute=None, max_retries=6, timeout=600):
         import openai
         self.openai = openai
-        self.client = self.openai.OpenAI(api_key = api_key)
         self.model = model
         self.max_tokens = max_tokens
         self.temperature = 0.2
         self.top_p = 0.2
+        self.max_retries = max_retries
 
-    def run(self, system, user, opts=None):
-        messages = [
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+        async def setup():
+            # The client, its connection pool and the limiters belong to the background loop
+            self.client = self.openai.AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, timeout=timeout)
+            self.semaphore = asyncio.Semaphore(max_concurrency)
+            self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+            self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._call(setup())
+
+    def stop(self):
+        if self.loop.is_running():
+            self._call(self.client.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def _messages(self, system, user):
+        return [
             {'role': 'system', 'content': system},
             {'role': 'user', 'content': user}
         ]
 
-        text_response = None
+    def _estimate_tokens(self, system, user):
+        # Prompt tokens plus, unless capped by max_tokens, about as many tokens of output
+        prompt_tokens = estimate_tokens(system) + estimate_tokens(user)
+        if self.max_tokens is not None:
+            return prompt_tokens + self.max_tokens
+        return 2*prompt_tokens
+
+    def _retryable(self, e):
+        if isinstance(e, self.openai.APIConnectionError):
+            return True
+        if isinstance(e, self.openai.APIStatusError):
+            return e.status_code == 429 or e.status_code >= 500
+        return False
+
+    async def _request(self, tokens, consume=None, **kwargs):
+        """
+        Send a chat completions request, and return the response, or, if given, what the coroutine
+        function consume returns for it. consume runs while the request holds its place among the
+        max_concurrency requests in flight, which is needed for streamed responses, since these are
+        only read after create() returns. Only failures of create() itself are retried.
+        """
+        for attempt in range(self.max_retries + 1):
+            if self.request_bucket is not None:
+                await self.request_bucket.acquire(1)
+            if self.token_bucket is not None:
+                await self.token_bucket.acquire(tokens)
+            async with self.semaphore:
+                try:
+                    response = await self.client.chat.completions.create(
+                        model=self.model,
+                        max_tokens=self.max_tokens,
+                        temperature=self.temperature,
+                        top_p=self.top_p,
+                        **kwargs
+                    )
+                except Exception as e:
+                    if attempt >= self.max_retries or not self._retryable(e):
+                        raise
+                    delay = retry_delay(e, attempt)
+                    error = e
+                else:
+                    if consume is None:
+                        return response
+                    return await consume(response)
+            # Waiting happens outside the semaphore, so that other requests can go ahead
+            print(f"Retrying OpenAI API request in {delay:.1f} s after error: {error}", file=sys.stderr)
+            await asyncio.sleep(delay)
+
+    async def _complete(self, system, user):
+        tokens = self._estimate_tokens(system, user)
+        response = await self._request(tokens, messages=self._messages(system, user))
+        if self.token_bucket is not None and response.usage is not None:
+            self.token_bucket.adjust(response.usage.total_tokens - tokens)
+        return response
+
+    async def _stream(self, system, user, chunks):
+        # Returns the token usage, which the final chunk of the stream has
+        async def consume(response):
+            usage = None
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    chunks.put(chunk.choices[0].delta.content)
+                if getattr(chunk, 'usage', None) is not None:
+                    usage = chunk.usage
+            return usage
+
+        usage = None
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                max_tokens=self.max_tokens,
-                temperature=self.temperature,
-                top_p=self.top_p
-            )
-            text_response = response.choices[0].message.content.strip()
-        except Exception as e:
-            print(f"Error querying OpenAI API: {e}", file=sys.stderr)
-            return None
+            tokens = self._estimate_tokens(system, user)
+            usage = await self._request(tokens, consume, messages=self._messages(system, user), stream=True, stream_options={'include_usage': True})
+            if self.token_bucket is not None and usage is not None:
+                self.token_bucket.adjust(usage.total_tokens - tokens)
+        finally:
+            chunks.put(None)
+        return usage
 
+    def run(self, system, user, opts=None):
+        response = self._call(self._complete(system, user))
+        if response.usage is not None:
+            timings.annotate("llm", prompt_tokens=response.usage.prompt_tokens, completion_tokens=response.usage.completion_tokens)
+        text_response = response.choices[0].message.content.strip()
         print("Response:",text_response)
         return text_response
 
+    def stream(self, system, user, opts=None):
+        # The background loop hands over the chunks through a queue, None marks the end
+        chunks = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self._stream(system, user, chunks), self.loop)
+
+        def deltas():
+            while True:
+                chunk = chunks.get()
+                if chunk is None:
+                    break
+                yield chunk
+            # Raises the error, if the request failed
+            usage = future.result()
+            if usage is not None:
+                timings.annotate("llm", prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+
+        try:
+            yield from strip_stream(deltas())
+        finally:
+            # If the consumer stops reading early, the request is cancelled, which frees its slot
+            if not future.done():
+                future.cancel()
+
 
 class Copilot:
     def __init__(self, key, style="precise"):
@@ -182,3 +722,6 @@ class Copilot:
     def run(self, system, user, opts=None):
         response = asyncio.run(self.sydney.compose("Act this way:\n"+system + "\n\nPlease answer:\n" + user))
         return response
+
+    def stream(self, system, user, opts=None):
+        yield self.run(system, user, opts)
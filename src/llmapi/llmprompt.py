@@ -1,8 +1,12 @@
-import os, json, copy
+import os, json, copy, time, logging
 
 import yaml
 
-from . import llmmodels
+from . import llmbackends
+from .llmcache import LlmCache
+from .fileutils import atomic_write
+from .texttools import estimate_tokens
+from .timing import timings
 
 class LlmPrompt:
 
@@ -34,8 +38,9 @@ class LlmPrompt:
                 template = cls._template_cache[template_filename]
         prompt_data = {}
 
-        for key in ['system', 'user']:
-            prompt_data[key] = template[key].format(text=text)
+        with timings.span("template"):
+            for key in ['system', 'user']:
+                prompt_data[key] = template[key].format(text=text)
 
         if 'meta' in template:
             prompt_meta = copy.deepcopy(template['meta'])
@@ -51,30 +56,88 @@ class LlmPrompt:
                 
         return LlmPrompt(prompt_data,meta=prompt_meta)
 
-    def execute(self, opts={}, backend='locallama'):
-
-        if backend is None or backend == 'localllama':
-            llm = llmmodels.LocalLlama8B()
-        elif backend == 'openai':
-            if opts['openai_key'] is None:
-                raise Exception("Trying to use OpenAI without API key set")
-            llm=llmmodels.OpenAI(api_key=opts['openai_key'])
-        elif backend == 'copilot':
-            if opts['copilot_key'] is None:
-                raise Exception("Trying to use Copilot without key (cookie) set")
-            llm=llmmodels.Copilot(key=opts['copilot_key'])
-        else:
-            raise Exception("Unknown LLM backend requested")
-
-        result = llm.run(self.prompt_data['system'],self.prompt_data['user'],opts=opts)
+    @classmethod
+    def get_backend(cls, opts, backend):
+        if backend is None:
+            backend = 'localllama'
+        return llmbackends.get_backend(backend, opts)
+
+    def _cached(self, opts, backend, llm):
+        """
+        Return (cache, cache_key, cached result) for this prompt; cache is None when caching is off.
+        """
+        cache = None
+        # Backends that record or replay interactions must see every prompt
+        if not getattr(opts, 'no_cache', False) and getattr(llm, 'cacheable', True):
+            cache = LlmCache.from_opts(opts)
+        if cache is None:
+            return None, None, None
+
+        cache_key = LlmCache.key(backend, llm, self.prompt_data['system'], self.prompt_data['user'])
+        if getattr(opts, 'refresh_cache', False):
+            return cache, cache_key, None
+        return cache, cache_key, cache.get(cache_key)
+
+    def _finish(self, result, cache, cache_key):
         if result.endswith("<|loop_detected|>"):
-            print("ERROR: Llm model entered a loop. Try other options, e.g., run post-processing in smaller chunks.")
-        
+            logging.error("llmprompt: Llm model entered a loop. Try other options, e.g., run post-processing in smaller chunks.")
+        elif cache is not None:
+            cache.put(cache_key, result)
+
+    def _span(self, backend, llm):
+        return timings.span("llm", backend=backend, model=getattr(llm, 'model', None) or getattr(llm, 'model_path', None))
+
+    def _count_tokens(self, record, result):
+        # Backends that know the exact token counts report them with timings.annotate()
+        if 'prompt_tokens' not in record:
+            record['prompt_tokens'] = estimate_tokens(self.prompt_data['system']) + estimate_tokens(self.prompt_data['user'])
+            record['completion_tokens'] = estimate_tokens(result or "")
+            record['estimated'] = True
+
+    def execute(self, opts={}, backend='localllama'):
+
+        llm = self.get_backend(opts, backend)
+        cache, cache_key, result = self._cached(opts, backend, llm)
+
+        if result is None:
+            with self._span(backend, llm) as record:
+                result = llm.run(self.prompt_data['system'],self.prompt_data['user'],opts=opts)
+                self._count_tokens(record, result)
+            self._finish(result, cache, cache_key)
+
         self.output = self.prompt_data['prefix'] + result + self.prompt_data['suffix']
 
         return self.output
 
-    
+    def stream(self, opts={}, backend='localllama'):
+        """
+        Execute the prompt and yield the output in chunks as the backend produces them.
+        The complete output is available in self.output once the generator is exhausted.
+        """
+        llm = self.get_backend(opts, backend)
+        cache, cache_key, result = self._cached(opts, backend, llm)
+
+        yield self.prompt_data['prefix']
+
+        if result is None:
+            chunks = []
+            with self._span(backend, llm) as record:
+                start = time.perf_counter()
+                for chunk in llm.stream(self.prompt_data['system'],self.prompt_data['user'],opts=opts):
+                    if not chunks:
+                        record['ttft'] = time.perf_counter() - start
+                    chunks.append(chunk)
+                    yield chunk
+                result = ''.join(chunks)
+                self._count_tokens(record, result)
+            self._finish(result, cache, cache_key)
+        else:
+            yield result
+
+        yield self.prompt_data['suffix']
+
+        self.output = self.prompt_data['prefix'] + result + self.prompt_data['suffix']
+
     @classmethod    
     def serialize_prompt(cls, p):
         return "\n== System ==\n" + str(p['system']) + "\n== User ==\n" + str(p['user'])
@@ -117,7 +180,31 @@ class LlmPrompt:
         else:
             deltas = None
 
-        return Prompt(prompt_data, meta, filename=filename, output=output, deltas=deltas)
+        return cls(data_prompt, meta, filename=barename + '.prompt', output=output, deltas=deltas)
+
+    def looped(self):
+        """
+        Return True if the output of this prompt ended because the LLM entered a loop.
+        """
+        return self.output is not None and "<|loop_detected|>" in self.output
+
+    def read_output(self, filename):
+        """
+        Take the output of this prompt from an earlier run written to filename, if the stored
+        prompt is the same as this one and has an output. Returns True if the output was taken.
+        """
+        if not os.path.exists(filename):
+            return False
+
+        stored = self.read(filename)
+        if stored.output is None or stored.looped():
+            return False
+        for key in ['system', 'user']:
+            if stored.prompt_data[key] != str(self.prompt_data[key]).strip():
+                return False
+
+        self.output = stored.output
+        return True
 
     def write(self, filename=None):
 
@@ -138,12 +225,10 @@ class LlmPrompt:
             json.dump(self.meta, f)
 
         if self.output is not None:
-            filename = self.barename+".output"
-            with open(filename, 'w') as f:
-                f.write(self.output)
+            atomic_write(self.barename+".output", self.output)
 
         if self.deltas is not None:
             filename = self.barename+".deltas"
             with open(filename, 'w') as f:
-                json.dump(self.deltas)          
+                json.dump(self.deltas, f)
         
@@ -1,32 +1,46 @@
 import os, logging
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 
+from . import llmbackends
 from .llmprompt import LlmPrompt
-from .texttools import split_markdown_by_headers, split_markdown_by_paragraph
+from .texttools import split_markdown_by_headers, split_markdown_by_paragraph, split_markdown_by_token_budget, TextSegments
 
 class LlmPromptSet:
 
+    _template_dir_cache = {}
+
     def __init__(self, prompts):
         self.prompts = prompts
+        self.segment_locs = {}
+
+    @classmethod
+    def read_templates(cls, template_dir, ext):
+        # Templates are parsed once per process and then reused for every text
+        key = (os.path.abspath(template_dir), ext)
+        if key not in cls._template_dir_cache:
+            templates = []
+            for filename in sorted(os.listdir(template_dir)):
+                if filename.endswith(ext):
+                    with open(os.path.join(template_dir,filename)) as f:
+                        template = yaml.safe_load(f)
+                    if 'meta' not in template:
+                        logging.warning("llmpromptset: rejecting prompt because of missing meta: "+str(filename))
+                        continue
+                    templates += [template]
+            cls._template_dir_cache[key] = templates
+        return cls._template_dir_cache[key]
 
     @classmethod
-    def from_template_dir(cls, text, template_dir, lang, opts):
+    def from_template_dir(cls, text, template_dir, lang, opts, backend=None):
 
-        templates = []
         if lang:
             ext = "-" + lang+".yaml"
         else:
             ext = ".yaml"
-        
-        for filename in sorted(os.listdir(template_dir)):
-            if filename.endswith(ext):
-                with open(os.path.join(template_dir,filename)) as f:
-                    template = yaml.safe_load(f)
-                if 'meta' not in template:
-                    logging.warning("llmpromptset: rejecting prompt because of missing meta: "+str(filename))
-                    continue
-                templates += [template]
+
+        templates = cls.read_templates(template_dir, ext)
 
         prompts = []
                 
@@ -50,22 +64,97 @@ class LlmPromptSet:
                 else:
                     split_level = 2
                 text_segments = split_markdown_by_headers(text, split_level)
+            elif split == "token-budget":
+                if 'split_tokens' in template['meta']:
+                    split_tokens = template['meta']['split_tokens']
+                elif getattr(opts,'split_tokens',None) is not None:
+                    split_tokens = opts.split_tokens
+                else:
+                    split_tokens = llmbackends.get_backend_info(backend or 'localllama').split_tokens
+                text_segments = split_markdown_by_token_budget(text, split_tokens)
+            else:
+                raise Exception("Unknown split mode: "+str(split))
 
             for text_segment in text_segments:
                 prompts += [LlmPrompt.from_template(text_segment, template=template)]
 
         return cls(prompts)
             
-    def execute(self, opts={}, backend='locallama', separator=""):
-        text = ""
-        for prompt in self.prompts:
-            text += prompt.execute(opts, backend) + separator
-
-        return text
-    
-
-
-
-
-
-    
+    def _parallel(self, opts, backend, parallel):
+        if parallel is None:
+            parallel = getattr(opts, 'parallel', None)
+        if parallel is None:
+            parallel = llmbackends.get_backend_info(backend or 'localllama').parallel
+        return parallel
+
+    def _checkpoint_filename(self, checkpoint_dir, i):
+        return os.path.join(checkpoint_dir, "%04d.prompt" % (i+1))
+
+    def _resume(self, i, checkpoint_dir, resume):
+        # Returns True if the output of prompt i was taken from an earlier run
+        if checkpoint_dir is None or not resume:
+            return False
+        return self.prompts[i].read_output(self._checkpoint_filename(checkpoint_dir, i))
+
+    def _checkpoint(self, i, checkpoint_dir):
+        # Output that ended in a loop is not kept, so that --resume tries the prompt again
+        if checkpoint_dir is not None and not self.prompts[i].looped():
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            self.prompts[i].write(self._checkpoint_filename(checkpoint_dir, i))
+
+    def _run(self, i, opts, backend, checkpoint_dir, resume):
+        if self._resume(i, checkpoint_dir, resume):
+            return self.prompts[i].output
+        output = self.prompts[i].execute(opts, backend)
+        self._checkpoint(i, checkpoint_dir)
+        return output
+
+    def execute(self, opts={}, backend='localllama', separator="", parallel=None, checkpoint_dir=None, resume=False):
+        """
+        Execute the prompts and return the concatenated output. If checkpoint_dir is given, each
+        prompt and its output is written there as soon as it completes, and with resume set,
+        prompts with an output from an earlier run in checkpoint_dir are not executed again.
+        Afterwards, segment_locs maps the offset in the output where the output of each prompt
+        starts to the index of the prompt.
+        """
+        parallel = self._parallel(opts, backend, parallel)
+
+        def run(i):
+            return self._run(i, opts, backend, checkpoint_dir, resume)
+
+        if parallel <= 1 or len(self.prompts) <= 1:
+            outputs = [run(i) for i in range(len(self.prompts))]
+        else:
+            # Segments are dispatched concurrently, map() hands back the outputs in the original order
+            with ThreadPoolExecutor(max_workers=min(parallel, len(self.prompts))) as executor:
+                outputs = list(executor.map(run, range(len(self.prompts))))
+
+        segments = TextSegments()
+        for i, output in enumerate(outputs):
+            segments.append(output, key=i)
+            segments.append(separator)
+        self.segment_locs = segments.locs()
+        return str(segments)
+
+    def stream(self, opts={}, backend='localllama', separator="", parallel=None, checkpoint_dir=None, resume=False):
+        """
+        Execute the prompts and yield the output in order as it is produced. When prompts
+        run one at a time the output of each prompt is streamed chunk by chunk; when they
+        run concurrently each prompt's output is yielded as soon as it and all prompts
+        before it are done. Checkpointing works as for execute().
+        """
+        parallel = self._parallel(opts, backend, parallel)
+
+        if parallel <= 1 or len(self.prompts) <= 1:
+            for i, prompt in enumerate(self.prompts):
+                if self._resume(i, checkpoint_dir, resume):
+                    yield prompt.output
+                else:
+                    yield from prompt.stream(opts, backend)
+                    self._checkpoint(i, checkpoint_dir)
+                yield separator
+        else:
+            with ThreadPoolExecutor(max_workers=min(parallel, len(self.prompts))) as executor:
+                futures = [executor.submit(self._run, i, opts, backend, checkpoint_dir, resume) for i in range(len(self.prompts))]
+                for future in futures:
+                    yield future.result() + separator
@@ -0,0 +1,68 @@
+import asyncio, time, random, datetime, email.utils
+
+class TokenBucket:
+    """
+    Asyncio token bucket that lets through per_minute units per minute on average, in bursts of
+    at most capacity units (default: per_minute).
+    """
+    def __init__(self, per_minute, capacity=None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity if capacity is not None else per_minute
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        # A request larger than the bucket waits for a full bucket rather than forever
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                await asyncio.sleep((amount - self.level) / self.rate)
+
+    def adjust(self, amount):
+        """
+        Take amount more units from the bucket (or give back, if negative), e.g., when the
+        actual token usage of a request is known to differ from the estimate it acquired.
+        """
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+def retry_delay(error, attempt, base=1.0, maximum=60.0):
+    """
+    Return the number of seconds to wait before retry number attempt (counting from 0) after
+    error. A retry-after-ms or retry-after header on the error's response is honored, otherwise
+    the delay grows exponentially from base up to maximum, with random jitter.
+    """
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+
+    if headers.get('retry-after-ms') is not None:
+        try:
+            return float(headers['retry-after-ms']) / 1000.0
+        except ValueError:
+            pass
+    if headers.get('retry-after') is not None:
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            # retry-after may also be an HTTP date; anything else falls back to backoff
+            try:
+                date = email.utils.parsedate_to_datetime(headers['retry-after'])
+            except (TypeError, ValueError):
+                date = None
+            if date is not None:
+                if date.tzinfo is None:
+                    date = date.replace(tzinfo=datetime.timezone.utc)
+                return max(0.0, date.timestamp() - time.time())
+
+    return min(maximum, base * 2**attempt) * random.uniform(0.5, 1.0)
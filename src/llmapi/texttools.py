@@ -1,4 +1,4 @@
-import re
+import re, collections, bisect
 
 def get_repeating_pattern(s):
     i = (s+s).find(s, 1, -1)
@@ -35,4 +35,243 @@ def split_markdown_by_headers(markdown_text, level=1):
 
 def split_markdown_by_paragraph(markdown_text):
     return markdown_text.split("\n\n")
+
+def estimate_tokens(text):
+    # Rough count for llama and gpt style tokenizers, which average about four characters per token
+    return (len(text) + 3) // 4
+
+def _split_lines_on_empty(lines):
+    # Blocks of lines separated by empty lines, each block keeping its trailing empty lines
+    blocks = []
+    block = []
+    for i, line in enumerate(lines):
+        if block and line.strip() and not lines[i-1].strip():
+            blocks.append(block)
+            block = []
+        block.append(line)
+    if block:
+        blocks.append(block)
+    return blocks
+
+def split_markdown_blocks(markdown_text, max_tokens=None, count_tokens=estimate_tokens):
+    """
+    Split markdown into blocks separated by empty lines, without splitting inside display
+    equations ($$...$$, \\[...\\]) or LaTeX environments such as tables. The blocks keep their
+    trailing empty lines, so joining them gives back the original text.
+
+    Nougat output often has an equation or table cut short, which would keep the block open to
+    the end of the text. Hence, an open equation or environment is taken to end at the next
+    headline, and once the open block grows beyond max_tokens (if given), it is split on empty
+    lines after all.
+    """
+    blocks = []
+    block = []
+    block_tokens = 0
+    in_dollars = False
+    in_brackets = False
+    environments = 0
+    ended = False
+
+    for line in markdown_text.splitlines(keepends=True):
+        stripped = line.strip()
+        inside = in_dollars or in_brackets or environments > 0
+
+        if inside and re.match(r'#{1,6}\s', stripped + " "):
+            # A headline is never part of an equation or table
+            in_dollars = in_brackets = False
+            environments = 0
+            inside = False
+            ended = True
+
+        if ended and stripped and not inside:
+            blocks.append("".join(block))
+            block = []
+            block_tokens = 0
+            ended = False
+
+        block.append(line)
+        block_tokens += count_tokens(line)
+
+        if line.count("$$") % 2 == 1:
+            in_dollars = not in_dollars
+        if "\\[" in line:
+            in_brackets = True
+        if "\\]" in line:
+            in_brackets = False
+        environments += len(re.findall(r'\\begin\{', line)) - len(re.findall(r'\\end\{', line))
+        environments = max(environments, 0)
+
+        inside = in_dollars or in_brackets or environments > 0
+        if inside and max_tokens is not None and block_tokens > max_tokens:
+            # Most likely never closed: give up on it, and split what has been collected on empty lines
+            in_dollars = in_brackets = False
+            environments = 0
+            inside = False
+            parts = _split_lines_on_empty(block)
+            blocks += ["".join(part) for part in parts[:-1]]
+            block = parts[-1]
+            block_tokens = sum([count_tokens(part_line) for part_line in block])
+
+        if not stripped and not inside:
+            ended = True
+
+    if block:
+        blocks.append("".join(block))
+
+    return blocks
+
+def split_markdown_by_token_budget(markdown_text, max_tokens, count_tokens=estimate_tokens):
+    """
+    Greedily pack consecutive markdown blocks (see split_markdown_blocks) into segments of at
+    most max_tokens tokens. A single block larger than max_tokens gets a segment of its own.
+    """
+    segments = []
+    segment = []
+    segment_tokens = 0
+
+    for block in split_markdown_blocks(markdown_text, max_tokens, count_tokens):
+        tokens = count_tokens(block)
+        if segment and segment_tokens + tokens > max_tokens:
+            segments.append("".join(segment))
+            segment = []
+            segment_tokens = 0
+        segment.append(block)
+        segment_tokens += tokens
+
+    if segment:
+        segments.append("".join(segment))
+
+    return segments
     
+
+class TextSegments:
+    """
+    A text assembled from segments, e.g., pages or the outputs of prompts, in time linear in
+    its length, that keeps the offset where each keyed segment starts.
+
+    str() gives the text. locs() gives a dict from offsets to the keys of the segments starting
+    there, and key_at() the key of the segment a given offset of the text falls into.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.length = 0
+        self.starts = []
+        self.keys = []
+
+    def append(self, text, key=None):
+        """
+        Add text at the end. Text without key (e.g., separators) belongs to the keyed segment before it.
+        """
+        if key is not None:
+            self.starts.append(self.length)
+            self.keys.append(key)
+        self.parts.append(text)
+        self.length += len(text)
+
+    def __len__(self):
+        return self.length
+
+    def __str__(self):
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+    def locs(self):
+        return dict(zip(self.starts, self.keys))
+
+    def key_at(self, offset):
+        i = bisect.bisect_right(self.starts, offset) - 1
+        return self.keys[i] if i >= 0 else None
+
+
+class RepetitionDetector:
+    """
+    Incremental detection of LLM output that has entered a loop.
+
+    Text is given to feed() as it arrives, which returns True when the output loops, i.e.,
+    when either the current line is longer than window characters and its last window
+    characters repeat a pattern of at most max_pattern_length characters, or when none of
+    the last max_lines lines is unique.
+
+    Only the last window characters of the current line and counts of the last max_lines
+    lines are kept, so feed() costs O(len(text) + window) regardless of how long the
+    output gets.
+    """
+
+    def __init__(self, window=500, max_pattern_length=100, max_lines=30):
+        self.window = window
+        self.max_pattern_length = min(max_pattern_length, window // 2)
+        self.max_lines = max_lines
+
+        self.line_length = 0
+        self.line_parts = []
+        self.tail = ""
+
+        self.lines = collections.deque()
+        self.line_counts = {}
+        self.unique_lines = 0
+
+    def feed(self, text):
+        """
+        Add text to the output seen so far and return True if the output is looping.
+        """
+        looping = False
+        segments = text.split("\n")
+        for segment in segments[:-1]:
+            self._extend_line(segment)
+            if self._end_line():
+                looping = True
+        self._extend_line(segments[-1])
+        return self._line_loops() or looping
+
+    def _extend_line(self, segment):
+        if not segment:
+            return
+        self.line_length += len(segment)
+        self.line_parts.append(segment)
+        self.tail = (self.tail + segment)[-self.window:]
+
+    def _end_line(self):
+        line = "".join(self.line_parts).strip()
+        self.line_parts = []
+        self.line_length = 0
+        self.tail = ""
+
+        if len(self.lines) == self.max_lines:
+            old = self.lines.popleft()
+            count = self.line_counts[old] - 1
+            if count == 0:
+                del self.line_counts[old]
+                self.unique_lines -= 1
+            else:
+                self.line_counts[old] = count
+                if count == 1:
+                    self.unique_lines += 1
+
+        self.lines.append(line)
+        count = self.line_counts.get(line, 0) + 1
+        self.line_counts[line] = count
+        if count == 1:
+            self.unique_lines += 1
+        elif count == 2:
+            self.unique_lines -= 1
+
+        return self.unique_lines == 0
+
+    def _line_loops(self):
+        if self.line_length <= self.window:
+            return False
+
+        # If the tail repeats with period p <= max_pattern_length, so does its end, and then the
+        # first max_pattern_length characters of the end reoccur p characters later. Hence, only
+        # the periods where they reoccur need to be checked, which usually is none at all.
+        tail, max_p = self.tail, self.max_pattern_length
+        end = tail[-2*max_p:]
+        head = end[:max_p]
+        p = end.find(head, 1)
+        while p != -1 and p <= max_p:
+            if tail[p:] == tail[:-p]:
+                return True
+            p = end.find(head, p + 1)
+        return False
@@ -0,0 +1,115 @@
+import time, threading, json, contextlib, collections
+
+class Timings:
+    """
+    Collects timing spans: a name, the wall clock start time, the duration in seconds, and
+    further fields such as the page or the number of prompt and completion tokens.
+
+    Spans are kept in memory for summary_table(), and if a file is opened with open(),
+    also written to it as one JSON line per span as soon as the span ends.
+    """
+    def __init__(self):
+        self.spans = []
+        self.file = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def open(self, filename):
+        self.file = open(filename, 'a')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def _open_spans(self):
+        if not hasattr(self.local, 'spans'):
+            self.local.spans = []
+        return self.local.spans
+
+    def add(self, record):
+        with self.lock:
+            self.spans.append(record)
+            if self.file is not None:
+                self.file.write(json.dumps(record) + "\n")
+                self.file.flush()
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        """
+        Time the enclosed block as a span with the given name and fields. The record dict is
+        yielded, so that the block can add fields to it.
+        """
+        record = {'name': name, 'start': time.time()}
+        record.update(fields)
+        open_spans = self._open_spans()
+        open_spans.append(record)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            if record.get('completion_tokens'):
+                # The generation rate, i.e., not counting the time until the first token
+                generation = record['seconds'] - (record.get('ttft') or 0.0)
+                if generation > 0:
+                    record['tokens_per_second'] = record['completion_tokens'] / generation
+            # Spans held open by generators do not necessarily end in reverse order
+            for i in range(len(open_spans) - 1, -1, -1):
+                if open_spans[i] is record:
+                    del open_spans[i]
+                    break
+            self.add(record)
+
+    def annotate(self, name, **fields):
+        """
+        Add fields to the innermost open span with the given name in this thread, if any. This
+        lets, e.g., a backend report exact token counts to the span of the prompt calling it.
+        """
+        for record in reversed(self._open_spans()):
+            if record['name'] == name:
+                record.update(fields)
+                return
+
+    def summary(self):
+        """
+        Return per span name: count, total, mean and max seconds, total prompt and completion
+        tokens, completion tokens per second and mean time to first token.
+        """
+        with self.lock:
+            spans = list(self.spans)
+        groups = collections.defaultdict(list)
+        for record in spans:
+            groups[record['name']].append(record)
+
+        rows = []
+        for name, records in groups.items():
+            seconds = [record['seconds'] for record in records]
+            completion_tokens = sum([record.get('completion_tokens') or 0 for record in records])
+            generation = sum([record['seconds'] - (record.get('ttft') or 0.0) for record in records if record.get('completion_tokens')])
+            ttfts = [record['ttft'] for record in records if record.get('ttft') is not None]
+            rows += [{
+                'name': name,
+                'count': len(records),
+                'seconds': sum(seconds),
+                'mean': sum(seconds)/len(seconds),
+                'max': max(seconds),
+                'prompt_tokens': sum([record.get('prompt_tokens') or 0 for record in records]),
+                'completion_tokens': completion_tokens,
+                'tokens_per_second': completion_tokens/generation if completion_tokens and generation > 0 else None,
+                'ttft': sum(ttfts)/len(ttfts) if ttfts else None,
+            }]
+        return rows
+
+    def summary_table(self):
+        lines = ["%-16s %6s %10s %9s %9s %10s %10s %8s %8s" % ("stage", "count", "total s", "mean s", "max s", "tokens in", "tokens out", "tok/s", "ttft s")]
+        for row in self.summary():
+            tokens_per_second = "-" if row['tokens_per_second'] is None else "%.1f" % row['tokens_per_second']
+            ttft = "-" if row['ttft'] is None else "%.2f" % row['ttft']
+            lines += ["%-16s %6d %10.2f %9.3f %9.3f %10d %10d %8s %8s" % (
+                row['name'], row['count'], row['seconds'], row['mean'], row['max'],
+                row['prompt_tokens'], row['completion_tokens'], tokens_per_second, ttft)]
+        return "\n".join(lines)
+
+# The process-wide collection of spans that the tools record into
+timings = Timings()
@@ -0,0 +1,2 @@
+from .main import main
+from .corpus import synthetic_markdown
@@ -0,0 +1,43 @@
+import random
+
+words = [
+    "the", "model", "energy", "of", "a", "crystal", "is", "given", "by", "and", "we", "find", "that",
+    "structure", "phase", "diagram", "temperature", "pressure", "calculated", "results", "show",
+    "in", "with", "for", "this", "thesis", "method", "density", "functional", "theory", "data",
+    "large", "small", "between", "each", "which", "värme", "åtgärd", "större", "über",
+]
+
+def synthetic_sentence(rng):
+    sentence = " ".join(rng.choice(words) for _ in range(rng.randint(6, 24)))
+    if rng.random() < 0.2:
+        sentence += " \\(E = mc^{2}\\)"
+    return sentence[0].upper() + sentence[1:] + "."
+
+def synthetic_markdown(size, seed=42):
+    """
+    Generate a markdown document of about size characters that looks like Nougat output:
+    headlines on two levels, paragraphs, display equations and tables.
+    """
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    section = 0
+
+    while length < size:
+        r = rng.random()
+        if r < 0.05:
+            section += 1
+            part = "# " + str(section) + " " + synthetic_sentence(rng)[:40] + "\n\n"
+        elif r < 0.15:
+            part = "## " + synthetic_sentence(rng)[:40] + "\n\n"
+        elif r < 0.22:
+            part = "\\[E_{" + str(rng.randint(0, 99)) + "}=\\sum_{i}\\frac{1}{2}m_{i}v_{i}^{2}\\]\n\n"
+        elif r < 0.25:
+            rows = ["| " + " | ".join(rng.choice(words) for _ in range(4)) + " |" for _ in range(rng.randint(2, 8))]
+            part = "\n".join(rows) + "\n\n"
+        else:
+            part = " ".join(synthetic_sentence(rng) for _ in range(rng.randint(2, 8))) + "\n\n"
+        parts.append(part)
+        length += len(part)
+
+    return "".join(parts)
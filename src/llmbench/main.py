@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Benchmark the non-model parts of the llmtools text and prompt pipeline
+"""
+import argparse, logging, os, time, json, tracemalloc, types, tempfile
+
+from llmapi import LlmPrompt, LlmPromptSet, ExceptionWrapper
+from llmapi.texttools import split_markdown_by_headers, split_markdown_by_token_budget, get_partially_repeating_pattern, RepetitionDetector
+
+from ._version import __version__
+from .corpus import synthetic_markdown
+
+arguments = [
+    {
+        'names': ['--version'],
+        'action': 'version',
+        'version': '%(prog)s '+ __version__
+    },
+    {
+        'names': ['stages'],
+        'help': 'The benchmark stages to run (default: all).',
+        'nargs': '*',
+    },
+    {
+        'names': ['-d', '--debug'],
+        'help': 'Produce full tracebacks on error',
+        'action': 'store_true',
+        'default': False
+    },
+    {
+        'names': ['-v', '--verbose'],
+        'help': 'Increase verbosity of output',
+        'dest': 'verbosity',
+        'action': 'count',
+        'default': 3
+    },
+    {
+        'names': ['-q', '--quiet'],
+        'help': 'Decrease verbosity of output',
+        'action': 'count',
+        'default': 0
+    },
+    {
+        'names': ['-s', '--size'],
+        'help': 'Size in characters of the synthetic markdown document.',
+        'default': 2000000,
+        'type': int,
+    },
+    {
+        'names': ['-n', '--repeat'],
+        'help': 'Number of times to run each stage; the fastest run is reported.',
+        'default': 3,
+        'type': int,
+    },
+    {
+        'names': ['--latency'],
+        'help': 'Latency in seconds of each request to the fake LLM backend.',
+        'default': 0.05,
+        'type': float,
+    },
+    {
+        'names': ['--token-rate'],
+        'help': 'Tokens per second produced by the fake LLM backend (default: as fast as possible).',
+        'type': float,
+    },
+    {
+        'names': ['-j', '--parallel'],
+        'help': 'Number of requests in flight for the concurrent fake backend stage.',
+        'default': 8,
+        'type': int,
+    },
+    {
+        'names': ['--transcript'],
+        'help': 'Transcript for the replay stage, recorded with the record LLM backend on the synthetic document (default: record one from the fake backend first).',
+        'type': str,
+    },
+    {
+        'names': ['--replay-time-scale'],
+        'help': 'Factor on the recorded times in the replay stage (1 = original timing, 0 = no waiting).',
+        'default': 1.0,
+        'type': float,
+    },
+    {
+        'names': ['--stopping-steps'],
+        'help': 'Number of generated tokens to run the nougat stopping criterion stages for.',
+        'default': 3584,
+        'type': int,
+    },
+    {
+        'names': ['--stopping-batch'],
+        'help': 'Number of pages generated at the same time in the nougat stopping criterion stages.',
+        'default': 4,
+        'type': int,
+    },
+    {
+        'names': ['--device'],
+        'help': 'The torch device for the nougat stopping criterion stages.',
+        'default': 'cpu',
+        'type': str,
+    },
+    {
+        'names': ['--json'],
+        'help': 'Write the results as JSON lines to this file.',
+        'type': str,
+    },
+]
+
+prompts_dir = os.path.join(os.path.dirname(__file__),"..","prompts","pdf2md")
+
+def bench_split_headers(text, args):
+    return split_markdown_by_headers(text, 2)
+
+def bench_split_token_budget(text, args):
+    return split_markdown_by_token_budget(text, 2048)
+
+def bench_from_template(text, args):
+    template = {'system': "You translate texts.", 'user': "Please translate the following text:\n\n{text}", 'meta': {}}
+    return [LlmPrompt.from_template(segment, template=template) for segment in split_markdown_by_headers(text, 2)]
+
+def bench_from_template_dir(text, args):
+    opts = types.SimpleNamespace(split="headline", split_headline_level=2)
+    return LlmPromptSet.from_template_dir(text, os.path.join(prompts_dir,"postprocess"), "en", opts)
+
+def bench_loop_detection_pattern(text, args):
+    # The old per-chunk check used by LocalLlama8B before RepetitionDetector, for comparison
+    line = text.replace("\n", " ")
+    buff = ""
+    for i in range(0, len(line), 1024):
+        buff += line[i:i+1024]
+        if len(buff) > 500:
+            get_partially_repeating_pattern(buff[-500:], 100)
+
+def bench_loop_detection(text, args):
+    detector = RepetitionDetector()
+    for i in range(0, len(text), 1024):
+        detector.feed(text[i:i+1024])
+
+def fake_promptset(text, args, parallel, repeat=False):
+    opts = types.SimpleNamespace(split="token-budget", split_tokens=2048, parallel=parallel,
+                                 fake_latency=args.latency, fake_token_rate=args.token_rate, fake_repeat=repeat)
+    promptset = LlmPromptSet.from_template_dir(text, os.path.join(prompts_dir,"postprocess"), "en", opts, backend='fake')
+    return promptset.execute(opts, backend='fake')
+
+def bench_execute_sequential(text, args):
+    return fake_promptset(text, args, 1)
+
+def bench_execute_parallel(text, args):
+    return fake_promptset(text, args, args.parallel)
+
+def bench_execute_looping(text, args):
+    return fake_promptset(text, args, args.parallel, repeat=True)
+
+def record_transcript(text, args):
+    # Without a given transcript, the fake backend is recorded once, with the same prompts as the replay
+    if args.transcript is not None:
+        return
+    args.transcript = os.path.join(tempfile.mkdtemp(), "transcript.jsonl")
+    opts = types.SimpleNamespace(split="token-budget", split_tokens=2048, parallel=args.parallel, no_cache=True, transcript=args.transcript, record_backend='fake',
+                                 fake_latency=args.latency, fake_token_rate=args.token_rate, fake_repeat=False)
+    LlmPromptSet.from_template_dir(text, os.path.join(prompts_dir,"postprocess"), "en", opts, backend='record').execute(opts, backend='record')
+
+def replay_promptset(text, args, parallel):
+    opts = types.SimpleNamespace(split="token-budget", split_tokens=2048, parallel=parallel, no_cache=True, transcript=args.transcript, replay_time_scale=args.replay_time_scale)
+    promptset = LlmPromptSet.from_template_dir(text, os.path.join(prompts_dir,"postprocess"), "en", opts, backend='replay')
+    return promptset.execute(opts, backend='replay')
+
+def bench_execute_replay(text, args):
+    return replay_promptset(text, args, args.parallel)
+
+def bench_stopping_legacy(text, args):
+    from .stopping import bench_stopping_legacy
+    return bench_stopping_legacy(text, args)
+
+def bench_stopping(text, args):
+    from .stopping import bench_stopping
+    return bench_stopping(text, args)
+
+def bench_postprocess_legacy(text, args):
+    from .postprocess import bench_postprocess_legacy
+    return bench_postprocess_legacy(text, args)
+
+def bench_postprocess(text, args):
+    from .postprocess import bench_postprocess
+    return bench_postprocess(text, args)
+
+# name: (function, fraction of the document to use, or None for stages that do not process the document)
+stages = {
+    'split-headers': (bench_split_headers, 1.0),
+    'split-token-budget': (bench_split_token_budget, 1.0),
+    'from-template': (bench_from_template, 1.0),
+    'from-template-dir': (bench_from_template_dir, 1.0),
+    'loop-detection-pattern': (bench_loop_detection_pattern, 0.1),
+    'loop-detection': (bench_loop_detection, 1.0),
+    'execute-fake-sequential': (bench_execute_sequential, 0.05),
+    'execute-fake-parallel': (bench_execute_parallel, 0.05),
+    'execute-fake-looping': (bench_execute_looping, 0.05),
+    'execute-replay-parallel': (bench_execute_replay, 0.05),
+    'postprocess-legacy': (bench_postprocess_legacy, 1.0),
+    'postprocess': (bench_postprocess, 1.0),
+    'nougat-stopping-legacy': (bench_stopping_legacy, None),
+    'nougat-stopping': (bench_stopping, None),
+}
+
+# name: function run on the text before the stage is measured
+setups = {
+    'execute-replay-parallel': record_transcript,
+}
+
+def measure(function, text, args):
+    """
+    Return (seconds of the fastest run, peak traced memory in bytes) for running function on text.
+    """
+    seconds = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        function(text, args)
+        elapsed = time.perf_counter() - start
+        if seconds is None or elapsed < seconds:
+            seconds = elapsed
+
+    # Memory is measured in a separate run, since tracing slows the code down
+    tracemalloc.start()
+    try:
+        function(text, args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return seconds, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    for arg in arguments:
+        names = arg.pop('names')
+        parser.add_argument(*names, **arg)
+    args = parser.parse_args()
+
+    log_levels = [logging.CRITICAL, logging.ERROR, logging.WARNING, logging.INFO, logging.DEBUG]
+    args.log_level = log_levels[max(min(len(log_levels) - 1, args.verbosity-args.quiet),0)]
+
+    # Configure logging
+    logging.basicConfig(format='llmbench %(levelname)s: %(message)s',level=args.log_level)
+    logging.debug("invoked with: "+str(args))
+
+    # Turn on tracebacks, etc., if verbosity is max *or* the debug flag is given
+    args.debug = args.debug or args.log_level <= logging.DEBUG
+    ExceptionWrapper.debug = args.debug
+
+    try:
+
+        logging.info("Llmbench "+__version__+" started")
+
+        selected = args.stages if args.stages else list(stages.keys())
+        for name in selected:
+            if name not in stages:
+                raise Exception("Unknown benchmark stage: "+str(name)+" (available: "+", ".join(stages.keys())+")")
+
+        document = synthetic_markdown(args.size)
+
+        results = []
+        print(f"{'stage':<28} {'chars':>10} {'seconds':>10} {'MB/s':>10} {'peak MB':>10}")
+        for name in selected:
+            function, fraction = stages[name]
+            if fraction is None:
+                text = ""
+            else:
+                text = document[:int(len(document)*fraction)]
+            try:
+                if name in setups:
+                    setups[name](text, args)
+                seconds, peak = measure(function, text, args)
+            except ImportError as e:
+                print(f"{name:<28} skipped: {e}")
+                continue
+            result = {
+                'stage': name,
+                'chars': len(text),
+                'seconds': seconds,
+                'mb_per_s': len(text)/seconds/1e6 if seconds > 0 else None,
+                'peak_mb': peak/1e6,
+            }
+            if fraction is None:
+                result['us_per_token'] = seconds/args.stopping_steps*1e6
+            results.append(result)
+            line = f"{name:<28} {result['chars']:>10} {result['seconds']:>10.4f} {result['mb_per_s'] or 0:>10.2f} {result['peak_mb']:>10.2f}"
+            if 'us_per_token' in result:
+                line += f" {result['us_per_token']:>8.1f} us/token"
+            print(line)
+
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                for result in results:
+                    f.write(json.dumps(result)+"\n")
+
+    except Exception as e:
+        if args.debug:
+            raise
+        else:
+            print(e)
+            return 1
+
+if __name__ == "__main__":
+    main()
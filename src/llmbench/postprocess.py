@@ -0,0 +1,39 @@
+"""
+Benchmark of the cleanup of nougat output into markdown.
+"""
+import re
+
+from pdf2md.postprocess import Postprocessor, fix_headlines
+
+# The cleanup used before pdf2md.postprocess, for comparison: one re.sub per rule, with the
+# patterns compiled (or looked up in the re cache) on every call, over the whole document at once
+
+def legacy_postprocess(text, latex_delimiters=True):
+    text = re.sub(r'^.*\\bar{\\bar{\\bar{\\bar{.*$','',text,flags=re.MULTILINE)
+    text = fix_headlines(text)
+    text = re.sub(r'^(#+) [0-9]+(\.[0-9]+)*\.? (.*)$', r'\g<1> \g<3>', text, flags=re.MULTILINE)
+    text = re.sub(r'(?<=\.)(?=\\\[)','\n', text)
+    text = re.sub(r'(?<=\\\])(?=\.)','\n', text)
+    if latex_delimiters:
+        text = re.sub(r'\\\[|\\\]','$$', text)
+        text = re.sub(r'\\\(|\\\)','$', text)
+    return text
+
+def iter_pages(text, page_size=3000):
+    """
+    Yield text in pieces of about page_size characters, cut at line ends, like the pages of nougat output.
+    """
+    start = 0
+    while start < len(text):
+        end = text.find("\n", start + page_size)
+        if end < 0:
+            end = len(text)
+        yield text[start:end]
+        start = end + 1
+
+def bench_postprocess_legacy(text, args):
+    return legacy_postprocess(text)
+
+def bench_postprocess(text, args):
+    postprocessor = Postprocessor(latex_delimiters=True)
+    return "\n".join([postprocessor(page) for page in iter_pages(text)])
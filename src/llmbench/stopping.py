@@ -0,0 +1,94 @@
+"""
+Benchmark of the per token overhead of the nougat stopping criterion. Needs torch and transformers.
+"""
+from collections import defaultdict
+
+import torch
+
+from pdf2md.stopping import StoppingCriteriaScores
+
+# The stopping criterion used before pdf2md.stopping, for comparison: it moves the scores to the
+# cpu, reallocates its windows with torch.cat and loops over the batch in python on every token
+
+class LegacyRunningVarTorch:
+    def __init__(self, L=15, norm=False):
+        self.values = None
+        self.L = L
+        self.norm = norm
+
+    def push(self, x: torch.Tensor):
+        assert x.dim() == 1
+        if self.values is None:
+            self.values = x[:, None]
+        elif self.values.shape[1] < self.L:
+            self.values = torch.cat((self.values, x[:, None]), 1)
+        else:
+            self.values = torch.cat((self.values[:, 1:], x[:, None]), 1)
+
+    def variance(self):
+        if self.values is None:
+            return
+        if self.norm:
+            return torch.var(self.values, 1) / self.values.shape[1]
+        else:
+            return torch.var(self.values, 1)
+
+class LegacyStoppingCriteriaScores:
+    def __init__(self, threshold: float = 0.015, window_size: int = 200):
+        self.threshold = threshold
+        self.vars = LegacyRunningVarTorch(norm=True)
+        self.varvars = LegacyRunningVarTorch(L=window_size)
+        self.stop_inds = defaultdict(int)
+        self.stopped = defaultdict(bool)
+        self.size = 0
+        self.window_size = window_size
+
+    @torch.no_grad()
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        last_scores = scores[-1]
+        self.vars.push(last_scores.max(1)[0].float().cpu())
+        self.varvars.push(self.vars.variance())
+        self.size += 1
+        if self.size < self.window_size:
+            return False
+
+        varvar = self.varvars.variance()
+        for b in range(len(last_scores)):
+            if varvar[b] < self.threshold:
+                if self.stop_inds[b] > 0 and not self.stopped[b]:
+                    self.stopped[b] = self.stop_inds[b] >= self.size
+                else:
+                    self.stop_inds[b] = int(
+                        min(max(self.size, 1) * 1.15 + 150 + self.window_size, 4095)
+                    )
+            else:
+                self.stop_inds[b] = 0
+                self.stopped[b] = False
+        return all(self.stopped.values()) and len(self.stopped) > 0
+
+_scores = {}
+
+def synthetic_scores(args, vocab_size=50000, count=64):
+    """
+    Return count random score tensors of shape (batch, vocab_size) on args.device; the steps
+    cycle through them, so that generating scores is not part of the measurement.
+    """
+    key = (args.stopping_batch, args.device, vocab_size, count)
+    if key not in _scores:
+        generator = torch.Generator().manual_seed(0)
+        _scores[key] = [torch.randn((args.stopping_batch, vocab_size), generator=generator).to(args.device) for _ in range(count)]
+    return _scores[key]
+
+def run_criterion(criterion, args, scores):
+    input_ids = torch.zeros((args.stopping_batch, 1), dtype=torch.long, device=args.device)
+    for step in range(args.stopping_steps):
+        # The legacy criterion needs the scores of all steps so far, but only looks at the last one
+        criterion(input_ids, (scores[step % len(scores)],))
+    if args.device != "cpu":
+        torch.cuda.synchronize()
+
+def bench_stopping_legacy(text, args):
+    run_criterion(LegacyStoppingCriteriaScores(), args, synthetic_scores(args))
+
+def bench_stopping(text, args):
+    run_criterion(StoppingCriteriaScores(), args, synthetic_scores(args))
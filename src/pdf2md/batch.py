@@ -0,0 +1,84 @@
+"""
+Conversion of many documents in one pdf2md run.
+"""
+import os, glob, json, time, logging, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from llmapi import timings
+
+from .convert import count_pages
+from .document import convert_document
+
+def expand_filenames(names):
+    """
+    Expand the filename arguments into a list of documents: directories give the pdf files in
+    them, and names that do not exist are taken as glob patterns.
+    """
+    filenames = []
+    for name in names:
+        if os.path.isdir(name):
+            filenames += sorted(glob.glob(os.path.join(name, "*.pdf")))
+        elif not os.path.exists(name) and glob.has_magic(name):
+            filenames += sorted(glob.glob(name, recursive=True))
+        else:
+            filenames += [name]
+    return filenames
+
+def init_worker(args):
+    # The main process writes the timing spans of the workers, see run_batch
+    timings.close()
+    # Load the models once per worker process, rather than once per document; nougat shards load their own
+    if args.extract_backend == "nougat" and args.nougat_workers <= 1:
+        from .pdf_to_md_nougat import get_model
+        get_model(args.nougat_model, args.device, args.dtype)
+
+def convert_one(filename, args):
+    start = time.monotonic()
+    first_span = len(timings.spans)
+    result = {'filename': filename, 'outfile': None, 'pages': None, 'seconds': None, 'error': None}
+    try:
+        result['pages'] = count_pages(filename, args.page_range)
+        result['outfile'] = convert_document(filename, args)
+    except Exception as e:
+        logging.error("Could not convert "+filename+": "+str(e))
+        result['error'] = type(e).__name__+": "+str(e)
+    result['seconds'] = time.monotonic() - start
+    # Worker processes hand their timing spans back to the main process with the result
+    result['spans'] = timings.spans[first_span:]
+    return result
+
+def run_batch(filenames, args):
+    """
+    Convert all filenames, args.workers at a time in separate processes, and print a summary.
+    Returns a list of one result dict per document (filename, outfile, pages, seconds, error).
+    """
+    if args.workers <= 1:
+        # In this process the model registry already loads the models only once
+        summary = [convert_one(filename, args) for filename in filenames]
+    else:
+        # Started fresh rather than forked, as the nougat shard pools are, since forking a process that
+        # already runs torch threads can deadlock
+        with ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=init_worker, initargs=(args,)) as executor:
+            summary = list(executor.map(convert_one, filenames, [args]*len(filenames)))
+        for result in summary:
+            for record in result['spans']:
+                record['document'] = result['filename']
+                timings.add(record)
+    for result in summary:
+        del result['spans']
+
+    print("== Summary")
+    for result in summary:
+        pages = "?" if result['pages'] is None else str(result['pages'])
+        status = "ok" if result['error'] is None else "FAILED: "+result['error']
+        print(f"{result['filename']}: {pages} pages, {result['seconds']:.1f} s, {status}")
+    failures = len([result for result in summary if result['error'] is not None])
+    print(f"{len(summary)} documents, {failures} failed")
+    print("=====================")
+
+    if args.summary is not None:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    return summary
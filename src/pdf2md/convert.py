@@ -1,15 +1,64 @@
+from llmapi import timings
 
-def convert_pdf2md(filename, page_range = None, backend="nougat"):
+def convert_pdf2md(filename, page_range = None, backend="nougat", batch_size=1, model="base", device=None, dtype=None, checkpoint_dir=None, resume=False, page_cache_dir=None, shards=1, threads=None, postprocessor=None, equation_ratio=0.05):
+    with timings.span("extract", backend=backend):
+        return _convert_pdf2md(filename, page_range, backend, batch_size, model, device, dtype, checkpoint_dir, resume, page_cache_dir, shards, threads, postprocessor, equation_ratio)
+
+def _convert_pdf2md(filename, page_range, backend, batch_size, model, device, dtype, checkpoint_dir, resume, page_cache_dir, shards, threads, postprocessor, equation_ratio):
 
     if backend == "mupdf":
         import pymupdf
-        with pymupdf.open(fname) as doc:
-            raw = '\n'.join([page.get_text() for page in doc])
+        with pymupdf.open(filename) as doc:
+            raw = '\n'.join([page.get_text() for i, page in enumerate(doc) if in_page_range(i, page_range)])
     elif backend == "pdfminer":
         from pdfminer.high_level import extract_text
-        raw = extract_text(filename)
+        page_numbers = None
+        if page_range is not None:
+            page_numbers = range(page_range[0], page_range[-1]+1)
+        raw = extract_text(filename, page_numbers=page_numbers)
     elif backend == "nougat":
         from .pdf_to_md_nougat import parse_pdf
-        raw, meta = parse_pdf(filename, page_range)
+        raw, meta = parse_pdf(filename, page_range, batch_size=batch_size, model=model, device=device, dtype=dtype, checkpoint_dir=checkpoint_dir, resume=resume, page_cache_dir=page_cache_dir, shards=shards, threads=threads, postprocessor=postprocessor)
+    elif backend == "auto":
+        from .pdf_to_md_mupdf import parse_pdf
+        raw, meta = parse_pdf(filename, page_range, postprocessor, equation_ratio, batch_size=batch_size, model=model, device=device, dtype=dtype, checkpoint_dir=checkpoint_dir, resume=resume, page_cache_dir=page_cache_dir, shards=shards, threads=threads)
+    else:
+        raise Exception("Unknown extraction backend: "+str(backend))
 
     return raw
+
+def in_page_range(page, page_range):
+    if page_range is None:
+        return True
+    if isinstance(page_range,int):
+        return page == page_range
+    elif len(page_range) == 1:
+        return page == page_range[0]
+    elif len(page_range) == 2:
+        return page >= page_range[0] and page <= page_range[1]
+    else:
+        raise Exception("Cannot interprete format of page_range: "+str(page_range))
+
+def page_separator(text):
+    # What to put between the previous page and a page starting with text
+    if text.startswith("#"):
+        return "\n\n"
+    elif text.startswith("."):
+        return "\n"
+    else:
+        return " "
+
+def count_pages(filename, page_range = None):
+    """
+    Return the number of pages of the PDF file within page_range, or None if it is not a PDF file.
+    """
+    if not filename.lower().endswith(".pdf"):
+        return None
+    import pymupdf
+    with pymupdf.open(filename) as doc:
+        page_count = len(doc)
+    if page_range is None:
+        return page_count
+    if len(page_range) == 1:
+        return 1 if page_range[0] < page_count else 0
+    return max(0, min(page_range[1], page_count - 1) - page_range[0] + 1)
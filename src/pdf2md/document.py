@@ -0,0 +1,70 @@
+import os, copy, logging, shutil
+
+from llmapi import LlmPromptSet
+
+from .convert import convert_pdf2md
+from .pipeline import run_pipeline
+from .postprocess import Postprocessor
+
+def convert_document(filename, args):
+    """
+    Convert one document according to the pdf2md command line arguments args, and return
+    the name of the markdown file written.
+    """
+    # The per-document settings below must not leak into the next document of a batch
+    args = copy.copy(args)
+
+    filename_bare, filename_ext = os.path.splitext(filename)
+    if args.outfile is None:
+        if args.outdir is not None:
+            os.makedirs(args.outdir, exist_ok=True)
+            args.outfile = os.path.join(args.outdir, os.path.basename(filename_bare) + '.md')
+        else:
+            args.outfile = filename_bare + '.md'
+
+    keep_workdir = args.workdir is not None
+    if args.workdir is None:
+        args.workdir = args.outfile + '.work'
+
+    def checkpoint_dir(stage):
+        return os.path.join(args.workdir, stage)
+
+    prompts_dir = os.path.join(os.path.dirname(__file__),"..","prompts","pdf2md")
+
+    stages = []
+    if args.postprocess:
+        stages += [("postprocess", args.lang)]
+    if args.translate is not None:
+        stages += [("translate", args.translate)]
+
+    if args.pipeline:
+        with open(args.outfile, 'w') as f:
+            run_pipeline(filename, args, stages, prompts_dir, checkpoint_dir, f)
+    else:
+        text = convert_pdf2md(filename, args.page_range, backend=args.extract_backend, batch_size=args.batch_size, model=args.nougat_model, device=args.device, dtype=args.dtype, checkpoint_dir=checkpoint_dir("extract"), resume=args.resume, page_cache_dir=args.page_cache, shards=args.nougat_workers, threads=args.nougat_threads, postprocessor=Postprocessor.from_opts(args), equation_ratio=args.equation_ratio)
+
+        print("== Extracted markdown")
+        print(text)
+        print("=====================")
+
+        for stage, lang in stages[:-1]:
+            promptset = LlmPromptSet.from_template_dir(text, os.path.join(prompts_dir,stage), lang, args, backend=args.translate_model)
+            text = promptset.execute(args, backend=args.translate_model, checkpoint_dir=checkpoint_dir(stage), resume=args.resume)
+
+        with open(args.outfile, 'w') as f:
+            if len(stages) > 0:
+                # The output of the last LLM stage is written to the outfile as it is produced
+                stage, lang = stages[-1]
+                promptset = LlmPromptSet.from_template_dir(text, os.path.join(prompts_dir,stage), lang, args, backend=args.translate_model)
+                for chunk in promptset.stream(args, backend=args.translate_model, checkpoint_dir=checkpoint_dir(stage), resume=args.resume):
+                    f.write(chunk)
+                    f.flush()
+            else:
+                f.write(str(text))
+
+    logging.info(f"Output written to {args.outfile}")
+
+    if not keep_workdir and os.path.exists(args.workdir):
+        shutil.rmtree(args.workdir)
+
+    return args.outfile
@@ -2,13 +2,12 @@
 """
 Convert pdf to md
 """
-import re, argparse, logging, os, sys, tomllib
-
-from llmapi import LlmPrompt, LlmPromptSet
+import argparse, logging, os, sys, tomllib
 
 from ._version import __version__
-from .convert import convert_pdf2md
-from llmapi import ExceptionWrapper, split_markdown_by_headers
+from .document import convert_document
+from .batch import expand_filenames, run_batch
+from llmapi import ExceptionWrapper, timings
  
 arguments = [
     {
@@ -18,7 +17,8 @@ arguments = [
     },
     {
         'names': ['filename'],
-        'help': 'The file name of the document to process.',
+        'help': 'The file name of the document to process. Several files, directories of pdf files, or glob patterns can be given to convert many documents in one run.',
+        'nargs': '+',
         'type': str,
     },
     {
@@ -55,8 +55,8 @@ arguments = [
     },
     {
         'names': ['-s', '--split'],
-        'help': 'Let the LLM process the whole document (none) or split it on paragraphs or headlines.',
-        'choices' : ['none', 'paragraph','headline'],
+        'help': 'Let the LLM process the whole document (none) or split it on paragraphs or headlines, or pack paragraphs into as few prompts as fit a token budget (token-budget).',
+        'choices' : ['none', 'paragraph','headline','token-budget'],
         'default': 'none',
         'type': str,
     },
@@ -65,7 +65,17 @@ arguments = [
         'help': 'Split LLM input at the selected header level (0 = all text at once, 1 = level one headings, 2 = level two headings, etc).',
         'default': 2,
         'type': int,
-    },        
+    },
+    {
+        'names': ['--split-tokens'],
+        'help': 'Maximum number of tokens of text per LLM prompt with --split token-budget (default depends on the backend: 4096 for openai, otherwise 2048).',
+        'type': int,
+    },
+    {
+        'names': ['-j', '--parallel'],
+        'help': 'Maximum number of LLM requests in flight at the same time, which for llamaserver is also the number of server slots (default depends on the backend: 1 for localllama, llamaserver and copilot, 8 for openai).',
+        'type': int,
+    },
     {
         'names': ['-t', '--translate'],
         'help': 'Translate the output to the selected language.',
@@ -82,25 +92,194 @@ arguments = [
         'help': 'Markdown filename to write.',
         'type': str,
     },
+    {
+        'names': ['-P', '--pipeline'],
+        'help': 'Pass completed sections on to the LLM postprocessing and translation while the rest of the document is still being extracted, instead of running one stage after another.',
+        'action': 'store_true',
+        'default': False
+    },
+    {
+        'names': ['--pipeline-depth'],
+        'help': 'Maximum number of sections waiting between two stages with --pipeline.',
+        'default': 2,
+        'type': int,
+    },
+    {
+        'names': ['-w', '--workdir'],
+        'help': 'Directory where each converted page and each LLM output is saved as soon as it is done (default: <outfile>.work, which is removed when the run completes).',
+        'type': str,
+    },
+    {
+        'names': ['--resume'],
+        'help': 'Resume an interrupted run from the work directory, skipping pages and LLM prompts that are already done. Use the same input and options as the interrupted run.',
+        'action': 'store_true',
+        'default': False
+    },
+    {
+        'names': ['--outdir'],
+        'help': 'Directory to write the markdown files to (default: next to each document).',
+        'type': str,
+    },
+    {
+        'names': ['-J', '--workers'],
+        'help': 'Number of worker processes converting documents at the same time when several documents are given. Each worker loads the models once.',
+        'default': 1,
+        'type': int,
+    },
+    {
+        'names': ['--summary'],
+        'help': 'Write a JSON summary of a multi-document run (pages, seconds and errors per document) to this file.',
+        'type': str,
+    },
+    {
+        'names': ['--timings'],
+        'help': 'Write the time spent in each step (rasterization, nougat per page, postprocessing, prompt templates and each LLM call with its token counts, time to first token and tokens per second) to this file, one JSON object per line.',
+        'type': str,
+    },
+    {
+        'names': ['--timing-summary'],
+        'help': 'Print a table of the time and tokens spent per step at the end of the run.',
+        'action': 'store_true',
+        'default': False
+    },
     {
         'names': ['-x', '--extract-backend'],
-        'help': 'The PDF text extraction backend to use.',
-        'choices': ['nougat','pdfminer','mupdf'],
+        'help': 'The PDF text extraction backend to use: auto converts pages with a usable text layer directly with PyMuPDF, and only scanned and equation-heavy pages with nougat.',
+        'choices': ['nougat','auto','pdfminer','mupdf'],
         'default': 'nougat',
         'type': str,
     },
+    {
+        'names': ['--equation-ratio'],
+        'help': 'With the auto extraction backend, convert pages with more than this fraction of their characters in formulas with nougat.',
+        'default': 0.05,
+        'type': float,
+    },
+    {
+        'names': ['-b', '--batch-size'],
+        'help': 'Number of pages the nougat backend converts in each model call.',
+        'default': 1,
+        'type': int,
+    },
+    {
+        'names': ['--nougat-model'],
+        'help': 'The nougat model to use with the nougat backend.',
+        'choices': ['small', 'base'],
+        'default': 'base',
+        'type': str,
+    },
+    {
+        'names': ['-K', '--nougat-workers'],
+        'help': 'Number of worker processes the nougat backend converts the pages of a document in, each with its own copy of the model. Useful on cpus, where one model call at a time leaves most cores idle.',
+        'default': 1,
+        'type': int,
+    },
+    {
+        'names': ['--nougat-threads'],
+        'help': 'Number of torch threads per nougat worker process (default: the number of cpus divided by the number of workers).',
+        'type': int,
+    },
+    {
+        'names': ['--page-cache'],
+        'help': 'Directory where the nougat backend caches the rendered and preprocessed pages, so that reruns on the same file skip both.',
+        'type': str,
+    },
+    {
+        'names': ['--device'],
+        'help': 'The torch device to run nougat on (default: cuda if available, otherwise cpu).',
+        'type': str,
+    },
+    {
+        'names': ['--dtype'],
+        'help': 'The torch dtype to run nougat with (default: the model default).',
+        'choices': ['float32', 'float16', 'bfloat16'],
+        'type': str,
+    },
     {
         'names': ['--openai-key'],
         'help': "API Token for OpenAPI",
         'type': str,
     },
+    {
+        'names': ['--openai-model'],
+        'help': "The OpenAI model to use.",
+        'default': 'gpt-4o',
+        'type': str,
+    },
+    {
+        'names': ['--openai-base-url'],
+        'help': "Base URL of the OpenAI API (default: the official API). Can point to any OpenAI compatible server.",
+        'type': str,
+    },
+    {
+        'names': ['--openai-rpm'],
+        'help': "Maximum number of OpenAI API requests per minute.",
+        'type': int,
+    },
+    {
+        'names': ['--openai-tpm'],
+        'help': "Maximum number of OpenAI API tokens per minute (prompt and completion, estimated before each request).",
+        'type': int,
+    },
+    {
+        'names': ['--cache-dir'],
+        'help': 'Cache LLM responses in this directory (e.g., ~/.cache/llmtools), so that unchanged prompts are not sent again on reruns. By default nothing is cached.',
+        'type': str,
+    },
+    {
+        'names': ['--cache-size'],
+        'help': 'Maximum size of the LLM response cache in MiB; the least recently used responses are removed beyond this.',
+        'default': 1024,
+        'type': float,
+    },
+    {
+        'names': ['--no-cache'],
+        'help': 'Do not read or write the LLM response cache, e.g., when --cache-dir is set in the config file.',
+        'action': 'store_true',
+        'default': False
+    },
+    {
+        'names': ['--refresh-cache'],
+        'help': 'Ignore cached LLM responses, but store the new responses in the cache.',
+        'action': 'store_true',
+        'default': False
+    },
+    {
+        'names': ['--prompt-cache-dir'],
+        'help': 'Directory where the localllama and llamaserver backends save the evaluated system prompt (llama.cpp KV cache), so that later prompts with the same system prompt only evaluate the text after it (e.g., ~/.cache/llmtools-prompts). By default nothing is saved.',
+        'type': str,
+    },
+    {
+        'names': ['--no-prompt-cache'],
+        'help': 'Do not save or load evaluated system prompts with the localllama and llamaserver backends, e.g., when --prompt-cache-dir is set in the config file.',
+        'action': 'store_true',
+        'default': False
+    },
     {
         'names': ['-m', '--translate-model'],
         'help': 'The LLM backend to use for translation.',
-        'choices': ['localllama', 'openai', 'copilot'],
+        'choices': ['localllama', 'llamaserver', 'openai', 'copilot', 'fake', 'record', 'replay'],
         'default': 'localllama',
         'type': str,
     },
+    {
+        'names': ['--transcript'],
+        'help': 'Transcript file that the record LLM backend appends the prompts and the output of --record-backend to, with the time of each chunk, and that the replay backend answers prompts from.',
+        'type': str,
+    },
+    {
+        'names': ['--record-backend'],
+        'help': 'The LLM backend that the record backend passes prompts on to.',
+        'choices': ['localllama', 'llamaserver', 'openai', 'copilot', 'fake'],
+        'default': 'localllama',
+        'type': str,
+    },
+    {
+        'names': ['--replay-time-scale'],
+        'help': 'Factor on the recorded times with the replay LLM backend (1 = original timing, 0 = no waiting).',
+        'default': 1.0,
+        'type': float,
+    },
 ]
 
 def main():
@@ -143,11 +322,6 @@ def main():
 
         logging.info("Pdf2md "+__version__+" started")
 
-        filename = args.filename
-        filename_bare, filename_ext = os.path.splitext(filename)
-        if args.outfile is None:
-            args.outfile = filename_bare + '.md'
-
         # Parse page range
         try:
             if args.range is not None:
@@ -160,26 +334,30 @@ def main():
         except Exception as e:
             raise ExceptionWrapper("Could not parse page range.", e) from e
 
-        text = convert_pdf2md(filename, args.page_range, backend=args.extract_backend)
+        filenames = expand_filenames(args.filename)
+        if len(filenames) == 0:
+            raise Exception("No documents to convert found in: "+", ".join(args.filename))
 
-        print("== Extracted markdown")
-        print(text)
-        print("=====================")
-        
-        prompts_dir = os.path.join(os.path.dirname(__file__),"..","prompts","pdf2md")
+        if args.timings is not None:
+            timings.open(args.timings)
 
-        if args.postprocess:
-            promptset = LlmPromptSet.from_template_dir(text, os.path.join(prompts_dir,"postprocess"), args.lang, args)
-            text = promptset.execute(args, backend=args.translate_model)
-                    
-        if args.translate is not None:
-            promptset = LlmPromptSet.from_template_dir(text, os.path.join(prompts_dir,"translate"), args.translate, args)
-            text = promptset.execute(args, backend=args.translate_model)
-                    
-        with open(args.outfile, 'w') as f:
-            f.write(str(text))
-
-        logging.info(f"Output written to {args.outfile}")
+        try:
+            if len(filenames) == 1:
+                convert_document(filenames[0], args)
+            else:
+                if args.outfile is not None:
+                    raise Exception("An outfile cannot be given when converting several documents, use --outdir instead.")
+                if args.workdir is not None:
+                    raise Exception("A workdir cannot be given when converting several documents.")
+                summary = run_batch(filenames, args)
+                if any([result['error'] is not None for result in summary]):
+                    return 1
+        finally:
+            timings.close()
+            if args.timing_summary:
+                print("== Timings")
+                print(timings.summary_table())
+                print("=====================")
 
     except Exception as e:
         if args.debug:
@@ -0,0 +1,45 @@
+import os, io, json, hashlib
+
+import torch
+
+from llmapi import atomic_write
+
+def file_hash(filename):
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class PageCache:
+    """
+    On-disk cache of the preprocessed nougat input tensors of the pages of one PDF file.
+
+    Entries are keyed on a hash of the file contents, the page, the DPI the page is rendered
+    at, and the model (whose processor does the preprocessing) and dtype, so reruns on the
+    same file skip both rendering and preprocessing. Entries are not removed automatically;
+    a page takes a few MB, and the cache directory can be removed at any time.
+    """
+    def __init__(self, cache_dir, filename, dpi, model, dtype):
+        self.cache_dir = cache_dir
+        self.params = {'file': file_hash(filename), 'dpi': dpi, 'model': model, 'dtype': str(dtype)}
+
+    def _path(self, page):
+        params = dict(self.params, page=page)
+        key = hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ".pt")
+
+    def get(self, page):
+        try:
+            return torch.load(self._path(page), weights_only=True)
+        except (OSError, RuntimeError, EOFError):
+            return None
+
+    def put(self, page, pixel_values):
+        path = self._path(page)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        buffer = io.BytesIO()
+        # A clone, since saving a view of a batch would save the whole batch
+        torch.save(pixel_values.clone(), buffer)
+        atomic_write(path, buffer.getvalue(), 'wb')
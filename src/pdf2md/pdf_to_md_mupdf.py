@@ -0,0 +1,172 @@
+"""
+Markdown from the text layer of born-digital PDF files with PyMuPDF, and the hybrid 'auto'
+extraction that sends only the pages without a usable text layer to nougat.
+"""
+import re, logging, unicodedata, collections
+
+import pymupdf
+
+from llmapi import timings, TextSegments
+
+from .convert import in_page_range, page_separator
+from .postprocess import Postprocessor
+
+# Fonts that TeX and office software set formulas in
+math_font_pattern = re.compile(r'CMMI|CMSY|CMEX|MSAM|MSBM|EUFM|RSFS|Math|Symbol|STIX|esint', re.IGNORECASE)
+
+# Pages with fewer characters in the text layer than this are taken to be scanned if they have images
+min_text_chars = 100
+
+# Pages with more than this fraction of replacement and control characters have a broken text layer
+max_garbage_ratio = 0.05
+
+def read_page(page):
+    """
+    Return the text blocks of a page as lists of lines, each a list of (text, size, font, bold) spans.
+    """
+    blocks = []
+    for block in page.get_text("dict", flags=pymupdf.TEXTFLAGS_TEXT)["blocks"]:
+        if block["type"] != 0:
+            continue
+        lines = []
+        for line in block["lines"]:
+            spans = [(span["text"], round(span["size"], 1), span["font"], bool(span["flags"] & pymupdf.TEXT_FONT_BOLD)) for span in line["spans"] if span["text"]]
+            if spans:
+                lines.append(spans)
+        if lines:
+            blocks.append(lines)
+    return blocks
+
+def page_stats(page, blocks):
+    """
+    Return (characters per font size, whether the page needs OCR, the fraction of characters in formulas)
+    for a page and its blocks from read_page.
+    """
+    sizes = collections.Counter()
+    chars = 0
+    garbage = 0
+    math = 0
+    for lines in blocks:
+        for spans in lines:
+            for text, size, font, bold in spans:
+                count = len(text.strip())
+                sizes[size] += count
+                chars += count
+                if math_font_pattern.search(font):
+                    math += count
+                else:
+                    math += sum([1 for c in text if unicodedata.category(c) == 'Sm'])
+                garbage += sum([1 for c in text if c == '\ufffd' or (unicodedata.category(c) == 'Cc' and c not in '\t\n')])
+
+    scanned = chars < min_text_chars and len(page.get_images()) > 0
+    broken = chars > 0 and garbage / chars > max_garbage_ratio
+    return sizes, scanned or broken, (math / chars if chars > 0 else 0.0)
+
+def heading_levels(sizes, max_levels=3):
+    """
+    Return a dict from font sizes to headline levels, given the characters per font size of the document:
+    the largest sizes clearly above the body text size get levels 1 to max_levels.
+    """
+    if not sizes:
+        return {}
+    body = sizes.most_common(1)[0][0]
+    larger = sorted([size for size in sizes if size >= body * 1.15], reverse=True)
+    return {size: level + 1 for level, size in enumerate(larger[:max_levels])}
+
+def join_lines(lines):
+    text = ""
+    for spans in lines:
+        line = "".join([span[0] for span in spans]).strip()
+        if not line:
+            continue
+        if text.endswith("-") and line[:1].islower():
+            # Undo hyphenation at the line end
+            text = text[:-1] + line
+        elif text:
+            text += " " + line
+        else:
+            text = line
+    return text
+
+def blocks_markdown(blocks, levels):
+    """
+    Return markdown for the blocks of a page from read_page: blocks set in a headline font size
+    become headlines, short blocks entirely in bold become bold lines (which the fix-headlines
+    postprocessing rule turns into headlines), and other blocks become paragraphs.
+    """
+    paragraphs = []
+    for lines in blocks:
+        text = join_lines(lines)
+        if not text:
+            continue
+        spans = [span for spans in lines for span in spans if span[0].strip()]
+        size = collections.Counter()
+        for span in spans:
+            size[span[1]] += len(span[0])
+        level = levels.get(size.most_common(1)[0][0])
+        if level is not None and len(text) < 200:
+            paragraphs.append("#" * level + " " + text)
+        elif len(text) < 200 and all([span[3] for span in spans]):
+            paragraphs.append("**" + text + "**")
+        else:
+            paragraphs.append(text)
+    return "\n\n".join(paragraphs)
+
+def iter_parse_pdf(filename, page_range=None, postprocessor=None, equation_ratio=0.05, **nougat_options):
+    """
+    Convert a PDF file to markdown page by page, and yield (page, markdown) for each page in page order.
+
+    Pages with a usable text layer are converted from it with PyMuPDF. Pages that look scanned, have a
+    broken text layer, or more than equation_ratio of their characters in formulas, are converted with
+    nougat (see pdf_to_md_nougat.iter_parse_pdf, which nougat_options are passed on to). All pages are
+    cleaned up with postprocessor (default: Postprocessor()).
+    """
+    if postprocessor is None:
+        postprocessor = Postprocessor()
+
+    page_blocks = {}
+    sizes = collections.Counter()
+    nougat_pages = []
+    with pymupdf.open(filename) as pdf:
+        for page in range(len(pdf)):
+            if not in_page_range(page, page_range):
+                continue
+            with timings.span("mupdf", page=page+1):
+                blocks = read_page(pdf[page])
+                page_sizes, needs_ocr, math = page_stats(pdf[page], blocks)
+            if needs_ocr or math > equation_ratio:
+                nougat_pages.append(page)
+            else:
+                page_blocks[page] = blocks
+                sizes.update(page_sizes)
+
+    logging.info("Converting %d pages from the text layer and %d pages with nougat" % (len(page_blocks), len(nougat_pages)))
+    levels = heading_levels(sizes)
+
+    nougat = iter(())
+    if nougat_pages:
+        from .pdf_to_md_nougat import iter_parse_pdf as iter_parse_pdf_nougat, clean_page, get_processor
+        processor = get_processor(nougat_options.get('model', "base"))
+        nougat = iter_parse_pdf_nougat(filename, pages=nougat_pages, **nougat_options)
+
+    for page in sorted(list(page_blocks) + nougat_pages):
+        if page in page_blocks:
+            with timings.span("postprocess", page=page+1):
+                text = postprocessor(blocks_markdown(page_blocks.pop(page), levels)).strip()
+        else:
+            _, text = next(nougat)
+            text = clean_page(text, processor, postprocessor)
+        yield page, text
+
+def parse_pdf(filename, page_range=None, postprocessor=None, equation_ratio=0.05, **nougat_options):
+    """
+    Convert a PDF file to markdown as iter_parse_pdf, and return the markdown and a dict with
+    'page_locs' (see pdf_to_md_nougat.parse_pdf).
+    """
+    segments = TextSegments()
+    for page, text in iter_parse_pdf(filename, page_range, postprocessor, equation_ratio, **nougat_options):
+        if len(segments) > 0:
+            segments.append(page_separator(text))
+        segments.append(text, key=page)
+
+    return str(segments).rstrip(), {'page_locs': segments.locs()}
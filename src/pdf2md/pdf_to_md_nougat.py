@@ -1,243 +1,299 @@
-#!venv.manual/bin/python3
 # https://github.com/NielsRogge/Transformers-Tutorials/blob/master/Nougat/Inference_with_Nougat_to_read_scientific_PDFs.ipynb
 
-import argparse, io, re
+import os, threading, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import Optional, List
-from collections import defaultdict
 
 import torch
 from transformers import AutoProcessor, VisionEncoderDecoderModel
 import fitz
-from huggingface_hub import hf_hub_download
 from PIL import Image
-from transformers import StoppingCriteria, StoppingCriteriaList
+from transformers import StoppingCriteriaList, LogitsProcessorList
 
-#processor = AutoProcessor.from_pretrained("facebook/nougat-small")
-#model = VisionEncoderDecoderModel.from_pretrained("facebook/nougat-small")
-processor = AutoProcessor.from_pretrained("facebook/nougat-base")
-model = VisionEncoderDecoderModel.from_pretrained("facebook/nougat-base")
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model.to(device)
+from llmapi import timings, TextSegments, atomic_write
 
-def rasterize_paper(
-    pdf: Path,
-    outpath: Optional[Path] = None,
-    dpi: int = 96,
-    return_pil=False,
-    pages=None,
-) -> Optional[List[io.BytesIO]]:
+from .stopping import StoppingCriteriaScores
+from .pagecache import PageCache
+from .postprocess import Postprocessor
+from .convert import in_page_range, page_separator
+
+class NougatModel:
+    """
+    A loaded nougat processor and model, placed on a device with a given dtype.
+    """
+    def __init__(self, name="facebook/nougat-base", device=None, dtype=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
+        self.name = name
+        self.device = device
+        self.processor = AutoProcessor.from_pretrained(name)
+        self.model = VisionEncoderDecoderModel.from_pretrained(name, torch_dtype=dtype)
+        self.model.to(device)
+        self.dtype = self.model.dtype
+
+_models = {}
+_processors = {}
+_models_lock = threading.Lock()
+
+def model_name(name):
+    if "/" not in name:
+        return "facebook/nougat-" + name
+    return name
+
+def get_model(name="base", device=None, dtype=None):
     """
-    Rasterize a PDF file to PNG images.
+    Return the process-wide NougatModel for the given model, device and dtype, loading it on first use.
 
     Args:
-        pdf (Path): The path to the PDF file.
-        outpath (Optional[Path], optional): The output directory. If None, the PIL images will be returned instead. Defaults to None.
-        dpi (int, optional): The output DPI. Defaults to 96.
-        return_pil (bool, optional): Whether to return the PIL images instead of writing them to disk. Defaults to False.
-        pages (Optional[List[int]], optional): The pages to rasterize. If None, all pages will be rasterized. Defaults to None.
+        name (str, optional): "small", "base", or the name of a model on the huggingface hub. Defaults to "base".
+        device (Optional[str], optional): The torch device. If None, cuda is used when available. Defaults to None.
+        dtype (Optional[str], optional): The torch dtype, e.g., "float16" or "bfloat16". If None, the model default is used. Defaults to None.
+    """
+    name = model_name(name)
+    key = (name, device, str(dtype))
+    with _models_lock:
+        if key not in _models:
+            _models[key] = NougatModel(name, device, dtype)
+        return _models[key]
+
+def get_processor(name="base"):
+    """
+    Return the nougat processor of the given model (see get_model), without loading the model itself
+    unless it is already loaded.
+    """
+    name = model_name(name)
+    with _models_lock:
+        for key, nougat in _models.items():
+            if key[0] == name:
+                return nougat.processor
+        if name not in _processors:
+            _processors[name] = AutoProcessor.from_pretrained(name)
+        return _processors[name]
+
+def render_page(pdf, page, dpi: int = 96):
+    """
+    Render a page of an open fitz document to a PIL image, directly from the pixel buffer.
+    """
+    with timings.span("rasterize", page=page+1):
+        pixmap = pdf[page].get_pixmap(dpi=dpi, alpha=False)
+        return Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
 
-    Returns:
-        Optional[List[io.BytesIO]]: The PIL images if `return_pil` is True, otherwise None.
+def page_tensor(pdf, page, nougat, dpi: int = 96, cache=None):
     """
+    Return the preprocessed nougat input of a page of an open fitz document, taken from the
+    PageCache cache if given and already there.
+    """
+    if cache is not None:
+        pixel_values = cache.get(page)
+        if pixel_values is not None:
+            return pixel_values
 
-    pillow_images = []
-    if outpath is None:
-        return_pil = True
-    try:
-        if isinstance(pdf, (str, Path)):
-            pdf = fitz.open(pdf)
-        if pages is None:
-            pages = range(len(pdf))
-        for i in pages:
-            page_bytes: bytes = pdf[i].get_pixmap(dpi=dpi).pil_tobytes(format="PNG")
-            if return_pil:
-                pillow_images.append(io.BytesIO(page_bytes))
-            else:
-                with (outpath / ("%02d.png" % (i + 1))).open("wb") as f:
-                    f.write(page_bytes)
-    except Exception:
-        pass
-    if return_pil:
-        return pillow_images
-
-
-class RunningVarTorch:
-    def __init__(self, L=15, norm=False):
-        self.values = None
-        self.L = L
-        self.norm = norm
-
-    def push(self, x: torch.Tensor):
-        assert x.dim() == 1
-        if self.values is None:
-            self.values = x[:, None]
-        elif self.values.shape[1] < self.L:
-            self.values = torch.cat((self.values, x[:, None]), 1)
-        else:
-            self.values = torch.cat((self.values[:, 1:], x[:, None]), 1)
+    image = render_page(pdf, page, dpi)
+    with timings.span("preprocess", pages=[page+1]):
+        pixel_values = nougat.processor(images=[image], return_tensors="pt").pixel_values[0].to(nougat.dtype)
 
-    def variance(self):
-        if self.values is None:
-            return
-        if self.norm:
-            return torch.var(self.values, 1) / self.values.shape[1]
-        else:
-            return torch.var(self.values, 1)
-
-
-class StoppingCriteriaScores(StoppingCriteria):
-    def __init__(self, threshold: float = 0.015, window_size: int = 200):
-        super().__init__()
-        self.threshold = threshold
-        self.vars = RunningVarTorch(norm=True)
-        self.varvars = RunningVarTorch(L=window_size)
-        self.stop_inds = defaultdict(int)
-        self.stopped = defaultdict(bool)
-        self.size = 0
-        self.window_size = window_size
-
-    @torch.no_grad()
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
-        last_scores = scores[-1]
-        self.vars.push(last_scores.max(1)[0].float().cpu())
-        self.varvars.push(self.vars.variance())
-        self.size += 1
-        if self.size < self.window_size:
-            return False
-
-        varvar = self.varvars.variance()
-        for b in range(len(last_scores)):
-            if varvar[b] < self.threshold:
-                if self.stop_inds[b] > 0 and not self.stopped[b]:
-                    self.stopped[b] = self.stop_inds[b] >= self.size
-                else:
-                    self.stop_inds[b] = int(
-                        min(max(self.size, 1) * 1.15 + 150 + self.window_size, 4095)
-                    )
-            else:
-                self.stop_inds[b] = 0
-                self.stopped[b] = False
-        return all(self.stopped.values()) and len(self.stopped) > 0
-
-def do_page(page_image):
-
-    pixel_values = processor(images=page_image, return_tensors="pt").pixel_values
-
-    outputs = model.generate(
-        pixel_values.to(device),
-        min_length=1,
-        max_length=3584,
-        bad_words_ids=[[processor.tokenizer.unk_token_id]],
-        return_dict_in_generate=True,
-        output_scores=True,
-        stopping_criteria=StoppingCriteriaList([StoppingCriteriaScores()]),
-    )
-
-    generated = processor.batch_decode(outputs[0], skip_special_tokens=True)[0]
+    if cache is not None:
+        cache.put(page, pixel_values)
+    return pixel_values
+
+def generate_pages(pixel_values, nougat, pages=None):
+    """
+    Run nougat on a batch of preprocessed pages and return the raw output for each.
+    """
+    if pages is None:
+        pages = list(range(len(pixel_values)))
+    pages = [page+1 for page in pages]
+
+    # The stopping criterion sees the scores through its logits processor, so generate() need not keep them all
+    stopping = StoppingCriteriaScores()
+    with timings.span("nougat", pages=pages) as record:
+        outputs = nougat.model.generate(
+            pixel_values.to(nougat.device, nougat.dtype),
+            min_length=1,
+            max_length=3584,
+            bad_words_ids=[[nougat.processor.tokenizer.unk_token_id]],
+            return_dict_in_generate=True,
+            logits_processor=LogitsProcessorList([stopping.processor]),
+            stopping_criteria=StoppingCriteriaList([stopping]),
+        )
+        record['completion_tokens'] = int((outputs[0] != nougat.processor.tokenizer.pad_token_id).sum())
+
+    generated = nougat.processor.batch_decode(outputs[0], skip_special_tokens=True)
 
     return generated
 
-def fix_headlines(text):
-    pattern = r'(?m)(^\s*$\n)(\s*\*\*(.*?)\*\*\s*)($\n^\s*$)'
+def page_checkpoint_filename(checkpoint_dir, page):
+    return os.path.join(checkpoint_dir, "page-%04d.mmd" % (page+1))
+
+def print_progress(batch, page_count):
+    if len(batch) == 1:
+        print("Converting page",batch[0]+1,"of",page_count)
+    else:
+        print("Converting pages",batch[0]+1,"to",batch[-1]+1,"of",page_count)
 
-    def replace_if_short(match):
-        content = match.group(3).strip()
-        if len(content) < 200:
-            return f'## {content}\n'
+def iter_batches(filename, pdf, todo, batch_size, model, device, dtype, page_cache_dir, dpi):
+    """
+    Convert the pages in todo in this process, and yield (batch, raw nougat outputs) for each batch.
+    """
+    nougat = get_model(model, device, dtype)
+    cache = None
+    if page_cache_dir is not None:
+        cache = PageCache(page_cache_dir, filename, dpi, nougat.name, nougat.dtype)
+
+    # Pages are run through the model batch_size at a time, so that every generate call works on larger tensors
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start+batch_size]
+        print_progress(batch, len(pdf))
+        # Only the selected pages are rendered, and only when their batch is next
+        pixel_values = torch.stack([page_tensor(pdf, page, nougat, dpi, cache) for page in batch])
+        yield batch, generate_pages(pixel_values, nougat, batch)
+
+# The model and open document of a shard worker process
+_shard = {}
+
+def init_shard(model, device, dtype, threads):
+    if threads is not None:
+        torch.set_num_threads(threads)
+    _shard['model'] = (model, device, dtype)
+    get_model(model, device, dtype)
+
+def convert_shard_batch(filename, batch, page_count, page_cache_dir, dpi):
+    """
+    Convert a batch of pages in a shard worker process, and return the raw nougat outputs and the
+    timing spans recorded while doing so.
+    """
+    first_span = len(timings.spans)
+    nougat = get_model(*_shard['model'])
+    if _shard.get('filename') != filename:
+        # A worker keeps the last document open for its next batch, and closes it when the next document comes
+        if _shard.get('pdf') is not None:
+            _shard['pdf'].close()
+        _shard['filename'] = filename
+        _shard['pdf'] = fitz.open(Path(filename))
+        _shard['cache'] = None
+        if page_cache_dir is not None:
+            _shard['cache'] = PageCache(page_cache_dir, filename, dpi, nougat.name, nougat.dtype)
+    print_progress(batch, page_count)
+    pixel_values = torch.stack([page_tensor(_shard['pdf'], page, nougat, dpi, _shard['cache']) for page in batch])
+    return generate_pages(pixel_values, nougat, batch), timings.spans[first_span:]
+
+def iter_sharded_batches(filename, pdf, todo, batch_size, model, device, dtype, page_cache_dir, dpi, shards, threads=None):
+    """
+    Convert the pages in todo in shards worker processes, each with its own copy of the model and
+    threads torch threads (default: an equal share of the cpus), and yield (batch, raw nougat
+    outputs) for each batch as soon as it is done.
+    """
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) // shards)
+    # Forking a process that already runs torch threads can deadlock, so the workers are started fresh
+    executor = ProcessPoolExecutor(max_workers=shards, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=init_shard, initargs=(model, device, dtype, threads))
+    try:
+        # The workers take the next batch as soon as they are done with one, so the pages are shared out evenly
+        futures = {}
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start:start+batch_size]
+            futures[executor.submit(convert_shard_batch, filename, batch, len(pdf), page_cache_dir, dpi)] = batch
+        for future in as_completed(futures):
+            texts, spans = future.result()
+            for record in spans:
+                timings.add(record)
+            yield futures[future], texts
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def iter_parse_pdf(filename, page_range = None, batch_size=1, model="base", device=None, dtype=None, checkpoint_dir=None, resume=False, page_cache_dir=None, dpi=96, shards=1, threads=None, pages=None):
+    """
+    Convert the pages of a PDF file with nougat, and yield (page, raw nougat output) for each page
+    in page order as soon as it is done.
+
+    If checkpoint_dir is given, the raw nougat output of each page is written there as soon as the
+    page is done, and with resume set, pages already in checkpoint_dir are not converted again.
+    If page_cache_dir is given, the preprocessed pages are cached there (see PageCache).
+    With shards > 1, the pages are converted in that many worker processes (see iter_sharded_batches).
+    If pages is given, only those pages are converted, regardless of page_range.
+    """
+    pdf = fitz.open(Path(filename))
+    try:
+        page_count = len(pdf)
+        if pages is None:
+            pages = [page for page in range(page_count) if in_page_range(page, page_range)]
         else:
-            return match.group(0)
+            pages = sorted(pages)
+
+        page_texts = {}
+        if checkpoint_dir is not None:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            if resume:
+                for page in pages:
+                    if os.path.exists(page_checkpoint_filename(checkpoint_dir, page)):
+                        with open(page_checkpoint_filename(checkpoint_dir, page), 'r') as f:
+                            page_texts[page] = f.read()
+                if len(page_texts) > 0:
+                    print("Resuming with",len(page_texts),"of",len(pages),"pages already converted")
+        todo = [page for page in pages if page not in page_texts]
+
+        done = 0
+        def completed():
+            # Yield the pages that are done and not preceded by any page that is not
+            nonlocal done
+            while done < len(pages) and pages[done] in page_texts:
+                yield pages[done], page_texts.pop(pages[done])
+                done += 1
+
+        yield from completed()
+        if len(todo) == 0:
+            return
 
-    replaced_text = re.sub(pattern, replace_if_short, text)
-    
-    return replaced_text
+        if shards > 1:
+            batches = iter_sharded_batches(filename, pdf, todo, batch_size, model, device, dtype, page_cache_dir, dpi, shards, threads)
+        else:
+            batches = iter_batches(filename, pdf, todo, batch_size, model, device, dtype, page_cache_dir, dpi)
+
+        for batch, texts in batches:
+            for page, text in zip(batch, texts):
+                page_texts[page] = text
+                if checkpoint_dir is not None:
+                    atomic_write(page_checkpoint_filename(checkpoint_dir, page), text)
+            yield from completed()
+    finally:
+        pdf.close()
+
+def clean_page(text, processor, postprocessor):
+    """
+    Clean up the raw nougat output of one page into markdown.
+    """
+    with timings.span("postprocess", chars=len(text)):
+        return postprocessor(processor.post_process_generation(text, fix_markdown=True).strip())
 
+def clean_markdown(text, processor, latex_delimiters=False, postprocessor=None):
+    """
+    Clean up concatenated raw nougat output into the final markdown.
+    """
+    if postprocessor is None:
+        postprocessor = Postprocessor(latex_delimiters=latex_delimiters)
+    return clean_page(text, processor, postprocessor)
 
-def fix_headlines(text):
+def parse_pdf(filename, page_range = None, latex_delimiters=False, batch_size=1, model="base", device=None, dtype=None, checkpoint_dir=None, resume=False, page_cache_dir=None, shards=1, threads=None, postprocessor=None):
+    """
+    Convert a PDF file to markdown with nougat. See iter_parse_pdf for checkpoint_dir, resume, page_cache_dir and shards.
+    Each page is cleaned up with postprocessor (default: Postprocessor(latex_delimiters=latex_delimiters)) as it is done.
 
-    pattern = r'(?m)^\s*\*\*(.*?)\*\*\s*$'
+    Returns the markdown and a dict with 'page_locs', which maps the offset in the markdown where
+    each page starts to the page (counted from 0).
+    """
+    if postprocessor is None:
+        postprocessor = Postprocessor(latex_delimiters=latex_delimiters)
+    processor = get_processor(model)
 
-    def replace_if_short(match):
-        content = match.group(1).strip()
-        if len(content) < 200:
-            return f"\n## {content}\n"
-        else:
-            return match.group(0)
-
-    replaced_text = re.sub(pattern, replace_if_short, text)
-    
-    return replaced_text
-
-
-def parse_pdf(filename, page_range = None, latex_delimiters=False):
-    images = rasterize_paper(pdf=Path(filename), return_pil=True)
-
-    loc = 0
-    all_text = ""
-    #page_locs = {}
-    for page, image in enumerate(images):
-        print("Converting page",page+1,"of",len(images))
-        if page_range is not None:
-            if isinstance(page_range,int):
-                if page != page_range:
-                    continue
-            elif len(page_range) == 1:
-                print("============= PAGE:",page,page_range[0])
-                if page != page_range[0]:
-                    continue
-            elif len(page_range) == 2:
-                if page < page_range[0] or page > page_range[1]:
-                    continue
-            else:
-                raise Exception("Cannot interprete format of page_range: "+str(page_range))
-        page_image = Image.open(image)
-        text = do_page(page_image)
+    segments = TextSegments()
+    for page, text in iter_parse_pdf(filename, page_range, batch_size, model, device, dtype, checkpoint_dir, resume, page_cache_dir, shards=shards, threads=threads):
         #text = re.sub('####* Abstract', '## Abstract', text)
-        if text[0] == "#":
-            all_text += "\n\n"
-        #    loc += 2
-        elif text[0] == ".":
-            all_text += "\n"
-        #    loc += 1
-        else:
-            all_text += " "
-        #    loc += 1
-        #text = processor.post_process_generation(text, fix_markdown=True).strip()
-        #loc += len(text)
-        #page_locs[loc]= page
-        all_text += text
-        
-    #return all_text, {'page_locs':page_locs}
-    all_text = processor.post_process_generation(all_text, fix_markdown=True).strip()
-
-    # Small Nougat tends to be confused about the abstract heading typically being small
-    # findal = re.sub('####* Abstract', '## Abstract', final)
-
-    # Patch odd reading errors
-    all_text = re.sub(r'^.*\\bar{\\bar{\\bar{\\bar{.*$','',all_text,flags=re.MULTILINE)
-    # Turn "fake"-headlines via otherwise empty lines in bold into headers
-    all_text = fix_headlines(all_text)
-    # Remove headline numbering
-    all_text = re.sub(r'^(#+) [0-9]+(\.[0-9]+)*\.? (.*)$', r'\g<1> \g<3>', all_text, flags=re.MULTILINE)
-    # Newlines for display equations
-    all_text = re.sub(r'(?<=\.)(?=\\\[)','\n', all_text)
-    all_text = re.sub(r'(?<=\\\])(?=\.)','\n', all_text)
-    if latex_delimiters:
-        # Use LaTeX display equations
-        all_text = re.sub(r'\\\[|\\\]','$$', all_text)
-        # Use LaTex inline equations
-        all_text = re.sub(r'\\\(|\\\)','$', all_text)
-
-    return all_text, {}
-
-def main(args):
-    text = parse_pdf(args.filename)
-    print(text)
-
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Convert file.")
-    parser.add_argument("filename", help="The file name to process")
-    parser.add_argument("-o", "--output", help="The output filename (defaults to <filename_base>.md")
-    args = parser.parse_args()
-
-    main(args)
+        text = clean_page(text, processor, postprocessor)
+        if len(segments) > 0:
+            segments.append(page_separator(text))
+        segments.append(text, key=page)
+
+    return str(segments).rstrip(), {'page_locs': segments.locs()}
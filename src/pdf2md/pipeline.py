@@ -0,0 +1,202 @@
+"""
+Pipelined pdf2md: converted pages flow through the LLM stages as sections are completed,
+instead of each stage waiting for the whole document.
+"""
+import os, re, logging, queue, threading
+
+from llmapi import LlmPromptSet, llmbackends, split_markdown_blocks
+
+from .convert import convert_pdf2md, page_separator
+from .postprocess import Postprocessor
+
+# Marks the end of the items in a queue
+_done = object()
+
+def find_cut(text, split, split_level=2, offset=0, pos=0, max_tokens=None):
+    """
+    Return the position in text up to which text that is still being extracted is complete, i.e.,
+    can be processed without knowing what follows it, or None: the last headline at or above
+    split_level for split mode 'headline', the start of the last block of split_markdown_blocks
+    (with max_tokens) for 'paragraph' and 'token-budget', so that equations and tables are not
+    cut, and nothing for 'none'. text starts at offset of the whole text, and a cut at the very
+    start of the whole text does not count. For 'headline', only text from pos on is searched,
+    with the character before pos telling whether pos is at the start of a line.
+    """
+    cut = None
+    if split == "headline":
+        for match in re.compile(rf'^#{{1,{split_level}}}\s', flags=re.MULTILINE).finditer(text, pos):
+            if offset + match.start() > 0:
+                cut = match.start()
+    elif split in ["paragraph", "token-budget"]:
+        blocks = split_markdown_blocks(text, max_tokens)
+        if len(blocks) > 1:
+            cut = len(text) - len(blocks[-1])
+    return cut
+
+class PendingText:
+    """
+    Text that is still being extracted, kept as a list of parts so that adding a part costs time
+    linear in the part. Only the new part, and the few characters before it that a boundary may
+    span, is searched for a cut, and the parts are only joined when a complete unit is taken out.
+    Paragraph cuts depend on whether an equation or table is open, so for 'paragraph' and
+    'token-budget' all pending text is searched, which max_tokens bounds for open blocks.
+    """
+    def __init__(self, split, split_level=2, max_tokens=None):
+        self.split = split
+        self.split_level = split_level
+        self.max_tokens = max_tokens
+        self.parts = []
+        self.length = 0
+
+    def add(self, part):
+        """
+        Add part at the end, and return the complete unit that this ends, or "".
+        """
+        # A headline marker that the new part completes starts at most split_level characters back,
+        # and one more character tells if it is at the start of a line
+        if self.split == "headline":
+            context = self.split_level + 2
+            previous = ""
+            for earlier in reversed(self.parts):
+                previous = earlier[-(context - len(previous)):] + previous
+                if len(previous) >= context:
+                    break
+            pos = 1 if len(previous) == context else 0
+        else:
+            previous = "".join(self.parts)
+            pos = 0
+        cut = find_cut(previous + part, self.split, self.split_level, self.length - len(previous), pos, self.max_tokens)
+        self.parts.append(part)
+        self.length += len(part)
+        if cut is None:
+            return ""
+        cut += self.length - len(part) - len(previous)
+        text = "".join(self.parts)
+        self.parts = [text[cut:]]
+        self.length = len(self.parts[0])
+        return text[:cut]
+
+    def rest(self):
+        return "".join(self.parts)
+
+def iter_units(filename, args, checkpoint_dir=None):
+    """
+    Extract the document and yield it as cleaned up markdown units as soon as each unit is complete.
+    """
+    postprocessor = Postprocessor.from_opts(args)
+    nougat_options = dict(batch_size=args.batch_size, model=args.nougat_model, device=args.device, dtype=args.dtype, checkpoint_dir=checkpoint_dir, resume=args.resume, page_cache_dir=args.page_cache, shards=args.nougat_workers, threads=args.nougat_threads)
+    if args.extract_backend == "auto":
+        from .pdf_to_md_mupdf import iter_parse_pdf
+        pages = iter_parse_pdf(filename, args.page_range, postprocessor, args.equation_ratio, **nougat_options)
+    elif args.extract_backend == "nougat":
+        from .pdf_to_md_nougat import iter_parse_pdf, clean_page, get_processor
+        processor = get_processor(args.nougat_model)
+        pages = ((page, clean_page(text, processor, postprocessor)) for page, text in iter_parse_pdf(filename, args.page_range, **nougat_options))
+    else:
+        yield convert_pdf2md(filename, args.page_range, backend=args.extract_backend)
+        return
+
+    max_tokens = None
+    if args.split == "token-budget":
+        max_tokens = getattr(args, 'split_tokens', None) or llmbackends.get_backend_info(args.translate_model or 'localllama').split_tokens
+    pending = PendingText(args.split, args.split_headline_level, max_tokens)
+    for page, text in pages:
+        unit = pending.add(page_separator(text) + text)
+        if unit.strip():
+            yield unit.strip()
+    rest = pending.rest()
+    if rest.strip():
+        yield rest.strip()
+
+def _put(q, item, failed):
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+def _get(q, failed):
+    while not failed.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _done
+
+def _produce(items, outqueue, failed, errors):
+    try:
+        for i, item in enumerate(items):
+            if failed.is_set():
+                break
+            _put(outqueue, (i, item), failed)
+    except BaseException as e:
+        errors.append(e)
+        failed.set()
+    finally:
+        _put(outqueue, _done, failed)
+
+def _transform(function, inqueue, outqueue, failed, errors):
+    try:
+        while True:
+            item = _get(inqueue, failed)
+            if item is _done:
+                break
+            i, unit = item
+            _put(outqueue, (i, function(i, unit)), failed)
+    except BaseException as e:
+        errors.append(e)
+        failed.set()
+    finally:
+        _put(outqueue, _done, failed)
+
+def run_pipeline(filename, args, stages, prompts_dir, checkpoint_dir, outfile):
+    """
+    Run extraction and the LLM stages (a list of (stage name, language)) concurrently, connected
+    by bounded queues of args.pipeline_depth units, and write the result to the open file outfile
+    as units come out of the last stage. Returns the full output text.
+    """
+    if args.split == "none":
+        logging.warning("With --split none, the whole document is one unit, so --pipeline cannot start the LLM stages before the extraction is done")
+
+    failed = threading.Event()
+    errors = []
+
+    def stage_function(stage, lang):
+        def function(i, unit):
+            promptset = LlmPromptSet.from_template_dir(unit, os.path.join(prompts_dir,stage), lang, args, backend=args.translate_model)
+            return promptset.execute(args, backend=args.translate_model, checkpoint_dir=os.path.join(checkpoint_dir(stage), "%04d" % (i+1)), resume=args.resume).strip()
+        return function
+
+    queues = [queue.Queue(maxsize=args.pipeline_depth)]
+    threads = [threading.Thread(target=_produce, args=(iter_units(filename, args, checkpoint_dir("extract")), queues[0], failed, errors))]
+    for stage, lang in stages:
+        queues.append(queue.Queue(maxsize=args.pipeline_depth))
+        threads.append(threading.Thread(target=_transform, args=(stage_function(stage, lang), queues[-2], queues[-1], failed, errors)))
+
+    for thread in threads:
+        thread.start()
+
+    outputs = []
+    try:
+        while True:
+            item = _get(queues[-1], failed)
+            if item is _done:
+                break
+            _, unit = item
+            if outputs:
+                outfile.write("\n\n")
+            outfile.write(unit)
+            outfile.flush()
+            outputs.append(unit)
+    except BaseException:
+        failed.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return "\n\n".join(outputs)
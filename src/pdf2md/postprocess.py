@@ -0,0 +1,98 @@
+"""
+Cleanup of raw nougat output into markdown, as a pipeline of precompiled regex rules.
+"""
+import re
+
+def short_headline(match):
+    # Turn "fake"-headlines, i.e., otherwise empty lines in bold, into headers
+    content = match.group(1).strip()
+    if len(content) < 200:
+        return f"\n## {content}\n"
+    else:
+        return match.group(0)
+
+# Functions that rules can name as their replacement, e.g., in the config file
+replacement_functions = {
+    'short_headline': short_headline,
+}
+
+# The rules are applied in order, each as one re.sub over the text. A rule with 'require' is
+# skipped for texts that contain none of the given strings, which is much faster than letting
+# the regex find that out, and most pages need only a few of the rules. A rule with an 'option'
+# is only used when that option is set.
+default_rules = [
+    # Patch odd reading errors
+    {'name': 'remove-bar-artifacts', 'pattern': r'^.*\\bar{\\bar{\\bar{\\bar{.*$', 'replacement': '', 'flags': ['MULTILINE'], 'require': ['\\bar{\\bar{\\bar{\\bar{']},
+    {'name': 'fix-headlines', 'pattern': r'^\s*\*\*(.*?)\*\*\s*$', 'replacement': 'short_headline', 'flags': ['MULTILINE'], 'require': ['**']},
+    {'name': 'remove-headline-numbering', 'pattern': r'^(#+) [0-9]+(\.[0-9]+)*\.? (.*)$', 'replacement': r'\g<1> \g<3>', 'flags': ['MULTILINE'], 'require': ['#']},
+    # Newlines for display equations
+    {'name': 'newline-before-display-equation', 'pattern': r'(?<=\.)(?=\\\[)', 'replacement': '\n', 'require': ['.\\[']},
+    {'name': 'newline-after-display-equation', 'pattern': r'(?<=\\\])(?=\.)', 'replacement': '\n', 'require': ['\\].']},
+    # Use LaTeX display and inline equations
+    {'name': 'latex-display-delimiters', 'pattern': r'\\\[|\\\]', 'replacement': '$$', 'require': ['\\[', '\\]'], 'option': 'latex_delimiters'},
+    {'name': 'latex-inline-delimiters', 'pattern': r'\\\(|\\\)', 'replacement': '$', 'require': ['\\(', '\\)'], 'option': 'latex_delimiters'},
+]
+
+class Rule:
+    """
+    A precompiled regex substitution. replacement is either a re.sub replacement string or the
+    name of one of the replacement_functions.
+    """
+    def __init__(self, name, pattern, replacement, flags=(), require=(), option=None):
+        self.name = name
+        self.require = list(require)
+        self.option = option
+        bits = 0
+        for flag in flags:
+            bits |= getattr(re, flag)
+        self.regex = re.compile(pattern, bits)
+        if replacement in replacement_functions:
+            self.replacement = replacement_functions[replacement]
+        else:
+            self.replacement = replacement
+
+    @classmethod
+    def from_dict(cls, rule):
+        return cls(rule.get('name'), rule['pattern'], rule.get('replacement', ''), rule.get('flags', ()), rule.get('require', ()), rule.get('option'))
+
+    def __call__(self, text):
+        if self.require and not any([required in text for required in self.require]):
+            return text
+        # re.sub returns text itself, i.e., without a copy, if nothing matches
+        return self.regex.sub(self.replacement, text)
+
+class Postprocessor:
+    """
+    The pipeline of rules that cleans up nougat output, meant to be run on each page as it is done.
+
+    Args:
+        rules: List of rule dicts (see default_rules). Defaults to default_rules.
+        extra_rules: Further rule dicts, e.g., from the config file, applied after the others.
+        disable: Names of rules not to use.
+        options: The options that rules depend on, e.g., latex_delimiters=True.
+    """
+    def __init__(self, rules=None, extra_rules=(), disable=(), **options):
+        if rules is None:
+            rules = default_rules
+        rules = [Rule.from_dict(rule) for rule in list(rules) + list(extra_rules) if rule.get('name') not in disable]
+        self.rules = [rule for rule in rules if rule.option is None or options.get(rule.option)]
+
+    @classmethod
+    def from_opts(cls, opts):
+        """
+        Return the pipeline with the extra rules (opts.postprocess_rules) and disabled rules
+        (opts.postprocess_disable) given in the config file.
+        """
+        return cls(extra_rules=getattr(opts, 'postprocess_rules', None) or (),
+                   disable=getattr(opts, 'postprocess_disable', None) or (),
+                   latex_delimiters=getattr(opts, 'latex_delimiters', False))
+
+    def __call__(self, text):
+        for rule in self.rules:
+            text = rule(text)
+        return text
+
+_fix_headlines = Rule.from_dict(default_rules[1])
+
+def fix_headlines(text):
+    return _fix_headlines(text)
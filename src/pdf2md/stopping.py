@@ -0,0 +1,98 @@
+"""
+Stopping criterion that ends nougat generation when the model starts to hallucinate.
+"""
+import torch
+from transformers import StoppingCriteria, LogitsProcessor
+
+class RingVarTorch:
+    """
+    Variance over the last L values pushed, per batch entry, kept in a preallocated ring
+    buffer on the device of the values.
+    """
+    def __init__(self, L=15, norm=False):
+        self.values = None
+        self.L = L
+        self.norm = norm
+        self.count = 0
+        self.pos = 0
+
+    def push(self, x: torch.Tensor):
+        if self.values is None:
+            self.values = torch.empty((x.shape[0], self.L), dtype=x.dtype, device=x.device)
+        self.values[:, self.pos] = x
+        self.pos = (self.pos + 1) % self.L
+        self.count = min(self.count + 1, self.L)
+
+    def variance(self):
+        if self.values is None:
+            return
+        if self.count == 1:
+            # The sample variance of a single value, without torch warning about it
+            return torch.full((self.values.shape[0],), float('nan'), dtype=self.values.dtype, device=self.values.device)
+        # The variance does not depend on the order of the values, so the ring needs no unrolling
+        variance = torch.var(self.values[:, :self.count], 1)
+        if self.norm:
+            return variance / self.count
+        return variance
+
+
+class StoppingCriteriaScores(StoppingCriteria):
+    """
+    Stop generating a sequence once the variance of the running variance of its top token
+    score has stayed below threshold for a while, which is how nougat hallucinations (e.g.,
+    endless repetitions) look.
+
+    All state is kept in tensors on the device the model runs on, so that no step waits for
+    the device, and each sequence of a batch stops on its own. The criterion is also a logits
+    processor (see processor), through which it sees the scores of every step; generate()
+    then does not have to keep the scores of all steps with output_scores=True.
+    """
+    def __init__(self, threshold: float = 0.015, window_size: int = 200):
+        super().__init__()
+        self.threshold = threshold
+        self.vars = RingVarTorch(norm=True)
+        self.varvars = RingVarTorch(L=window_size)
+        self.stop_inds = None
+        self.stopped = None
+        self.size = 0
+        self.window_size = window_size
+        self.observed = False
+        self.processor = _ScoreObserver(self)
+
+    def observe(self, scores: torch.FloatTensor):
+        self.vars.push(scores.max(1)[0].float())
+        self.varvars.push(self.vars.variance())
+        self.size += 1
+        self.observed = True
+
+    @torch.no_grad()
+    def __call__(self, input_ids: torch.LongTensor, scores, **kwargs):
+        if not self.observed:
+            # Without the processor, the scores of all steps so far are passed in (output_scores=True)
+            self.observe(scores[-1])
+        self.observed = False
+
+        if self.stopped is None:
+            self.stop_inds = torch.zeros(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
+            self.stopped = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if self.size < self.window_size:
+            return self.stopped
+
+        # Sequences with a low variance get a step to stop at, and stop once they reach it
+        # while the variance stays low; sequences with a high variance start over
+        low = self.varvars.variance() < self.threshold
+        waiting = low & (self.stop_inds > 0) & ~self.stopped
+        stop_ind = int(min(max(self.size, 1) * 1.15 + 150 + self.window_size, 4095))
+        self.stopped = torch.where(waiting, self.stop_inds >= self.size, self.stopped & low)
+        self.stop_inds = torch.where(low & ~waiting, stop_ind, self.stop_inds * low)
+        return self.stopped
+
+
+class _ScoreObserver(LogitsProcessor):
+    def __init__(self, criterion):
+        self.criterion = criterion
+
+    @torch.no_grad()
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor):
+        self.criterion.observe(scores)
+        return scores
@@ -3,4 +3,7 @@
 import sys
 
 from pdf2md import main
-sys.exit(main())
+
+# Guarded, since the batch and nougat shard worker processes import this module again
+if __name__ == "__main__":
+    sys.exit(main())